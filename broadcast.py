@@ -1,7 +1,8 @@
-import socket
 import threading
 import time
-from utils import get_broadcast_address
+from collections import deque
+from utils import (get_broadcast_address, get_broadcast_socket, get_timestamp,
+                   send_datagrams, MAX_SEND_BATCH)
 from protocol import Protocol, MessageType
 
 
@@ -16,17 +17,40 @@ class BroadcastSender:
         self.running = False
         self.thread = None
         self.socket = None
+        self._stop_event = threading.Event()
         self.neighbor_manager = None
 
         # 节点信息
         self.node_name = node_name or f"node_{local_port}"
 
+        # 二进制节点发现帧缓存，只有时间戳会随每次发送变化
+        self._bcast_addrs = []
+        self._frame = None
+        self._build_message_template()
+
+        # 待发送报文队列 [(data, addr), ...]，每个周期发往各目标地址的发现帧
+        # 一起批量发送
+        self._pending = deque()
+
     def start(self, show_message=True):
         """启动广播发送线程"""
         if self.running:
             return False
 
+        # 使用进程内共享的广播socket，停止后再启动也不必重新创建；
+        # socket是非阻塞的，发送缓冲区满时丢弃本次报文而不是阻塞广播周期
+        try:
+            self.socket = get_broadcast_socket()
+        except OSError as e:
+            print(f"[错误] 创建广播socket失败: {e}")
+            self.socket = None
+            return False
+
+        # 广播地址只在启动时获取一次，之后每次发送直接复用
+        self.refresh_broadcast_address()
+
         self.running = True
+        self._stop_event.clear()
         self.thread = threading.Thread(
             target=self._broadcast_loop, daemon=True)
         self.thread.start()
@@ -40,64 +64,85 @@ class BroadcastSender:
             return  # 如果没有运行，直接返回，不显示消息
 
         self.running = False
-        if self.socket:
-            try:
-                self.socket.close()
-            except:
-                pass
+        self._stop_event.set()
         if self.thread and self.thread.is_alive():
             self.thread.join(timeout=2)
+        # 共享的广播socket保留给下次启动使用，这里只释放引用
+        self.socket = None
         if show_message:
             print("[信息] 广播发送器已停止")
 
     def _broadcast_loop(self):
         """广播循环"""
-        # 启动后立即发送多次广播，确保被快速发现
-        for i in range(3):  # 前3次快速广播
-            if self.running:
-                try:
-                    self._send_broadcast()
-                    if i < 2:  # 最后一次不等待
-                        time.sleep(0.2)  # 200ms间隔
-                except Exception as e:
-                    print(f"[错误] 广播发送出错: {e}")
+        # 按单调时钟的截止时间调度，发送耗时不会累积成周期漂移
+        deadline = time.monotonic()
+        burst = 3  # 启动后前3次以200ms间隔快速广播，确保被快速发现
 
         while self.running:
             try:
-                time.sleep(self.interval)
-                if self.running:  # 检查是否还在运行
-                    self._send_broadcast()
+                self._send_broadcast()
             except Exception as e:
                 print(f"[错误] 广播发送出错: {e}")
-                time.sleep(self.interval)
 
-    def _send_broadcast(self):
-        """发送一次广播"""
-        try:
-            # 创建UDP socket
-            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+            if burst > 1:
+                burst -= 1
+                deadline += 0.2
+            else:
+                deadline += self.interval
 
-            # 设置超时，避免阻塞
-            sock.settimeout(1)
+            slack = deadline - time.monotonic()
+            if slack > 0:
+                # stop()会设置事件，等待立即结束
+                self._stop_event.wait(slack)
+            elif -slack > self.interval:
+                # 落后超过一个周期时重新对齐，避免连续补发
+                deadline = time.monotonic()
 
-            # 创建节点发现消息
-            data = Protocol.create_discovery_message(
-                self.node_name, self.local_ip, self.local_port)
+    def _send_broadcast(self):
+        """发送一次广播"""
+        sock = self.socket
+        if sock is None:
+            return
+
+        # 只写入当前时间戳，其余部分使用预先构造的发现帧
+        frame = self._frame
+        Protocol.DISCOVERY_TIMESTAMP.pack_into(
+            frame, Protocol.DISCOVERY_TIMESTAMP_OFFSET, get_timestamp())
+        for addr in self._bcast_addrs:
+            self._pending.append((frame, addr))
+        self._flush_pending(sock)
+
+    def _flush_pending(self, sock):
+        """批量发送队列中的报文，每次系统调用最多MAX_SEND_BATCH个"""
+        while self._pending:
+            batch = []
+            while self._pending and len(batch) < MAX_SEND_BATCH:
+                batch.append(self._pending.popleft())
 
-            if data:
-                broadcast_addr = get_broadcast_address()
-                sock.sendto(data, (broadcast_addr, self.broadcast_port))
+            try:
+                send_datagrams(sock, batch)
+            except BlockingIOError:
+                pass  # 发送缓冲区已满，丢弃本批报文，下个周期会重新广播
+            except Exception as e:
+                # 忽略停止过程中socket关闭以及端口占用错误的输出
+                if self.running and "Address already in use" not in str(e):
+                    print(f"[错误] 发送广播失败: {e}")
 
-            sock.close()
+    def refresh_broadcast_address(self):
+        """重新获取广播地址，网络环境变化时由上层调用"""
+        self._bcast_addrs = [(address, self.broadcast_port)
+                             for address in get_broadcast_address()]
+        return self._bcast_addrs
 
-        except Exception as e:
-            if "Address already in use" not in str(e):  # 忽略端口占用错误的输出
-                print(f"[错误] 发送广播失败: {e}")
+    def _build_message_template(self):
+        """预先构造二进制节点发现帧"""
+        self._frame = Protocol.create_discovery_frame(
+            self.node_name, self.local_ip, self.local_port)
 
     def update_node_name(self, name):
         """更新节点名称"""
         self.node_name = name
+        self._build_message_template()
 
     def get_node_info(self):
         """获取当前节点信息"""
@@ -115,7 +160,7 @@ class BroadcastSender:
         if self.node_name.startswith('node_'):
             from utils import generate_unique_node_name
             new_name = generate_unique_node_name(neighbor_manager)
-            self.node_name = new_name
+            self.update_node_name(new_name)
 
     def is_running(self):
         """检查是否正在运行"""
@@ -1,32 +1,108 @@
 import socket
+import struct
+import selectors
 import threading
 import sys
 import time
 from protocol import Protocol, MessageType
+from utils import (BatchReceiver, BufferPool, make_node_key, set_socket_buffers,
+                   get_monotonic_ns, DISCOVERY_MULTICAST_GROUP)
+from neighbors import NodeInfo
+
+
+# 重复广播的去重窗口（纳秒），略小于默认的广播间隔；过期摘要每秒清理一次
+_DEDUP_WINDOW_NS = 900_000_000
+_SEEN_EVICT_INTERVAL_NS = 1_000_000_000
+
+# 热路径上使用的常量和函数，绑定为模块级名称，避免每个报文重复查找类属性
+_NODE_DISCOVERY = MessageType.NODE_DISCOVERY
+_SEND_OFFER = MessageType.SEND_OFFER
+_FILE_RESPONSES = frozenset((MessageType.RECEIVE_CONFIRM,
+                             MessageType.RECEIVE_REJECT))
+_DISCOVERY_MAGIC = Protocol.DISCOVERY_MAGIC
+_parse_discovery_frame = Protocol.parse_discovery_frame
+_parse_message = Protocol.parse_message
+_ADDR_START = Protocol.DISCOVERY_ADDR_OFFSET
+_ADDR_END = _ADDR_START + Protocol.DISCOVERY_ADDR_SIZE
+
+# 广播端口上合法JSON消息的前缀（兼容有无空格两种序列化格式），
+# 其他报文在解析前直接丢弃
+_BROADCAST_JSON_PREFIXES = tuple(
+    (b'{"type":' + sep + b'"' + t.encode('ascii') + b'"')
+    for t in (_NODE_DISCOVERY, _SEND_OFFER)
+    for sep in (b' ', b'')
+)
+
+
+def _probe_reuseport():
+    """检测当前平台是否支持SO_REUSEPORT，只在模块加载时执行一次"""
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        return False
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as probe:
+            probe.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        return True
+    except OSError:
+        return False
+
+
+_HAVE_REUSEPORT = _probe_reuseport()
+
+# 监听socket的内核接收缓冲区大小，避免大量节点同时广播时丢包
+_RCVBUF_SIZE = 4 * 1024 * 1024
 
 
 class BroadcastListener:
     """统一监听器 - 同时处理广播发现和业务通信"""
 
-    def __init__(self, neighbor_manager, local_ip, local_port, broadcast_port=23333, file_receiver=None, file_sender=None):
+    def __init__(self, neighbor_manager, local_ip, local_port, broadcast_port=23333, file_receiver=None, file_sender=None,
+                 business_socket=None, discovery_event=None):
         self.neighbor_manager = neighbor_manager
         self.local_ip = local_ip
         self.local_port = local_port
         self.broadcast_port = broadcast_port
         self.running = False
 
-        # 广播监听
-        self.broadcast_thread = None
-        self.broadcast_socket = None
+        # 收到其他节点的发现消息时置位，供启动扫描阶段提前结束等待
+        self.discovery_event = discovery_event
 
-        # 业务监听
-        self.business_thread = None
+        # 本节点的整数键及发现帧中的地址字节，用于过滤自身广播
+        try:
+            self._self_key = make_node_key(local_ip, local_port)
+            self._self_addr = Protocol.pack_discovery_addr(local_ip, local_port)
+        except (OSError, TypeError, ValueError, OverflowError):
+            self._self_key = None
+            self._self_addr = None
+
+        # 广播监听和业务监听共用一个反应器线程
+        self._reactor_thread = None
+        self.broadcast_socket = None
         self.business_socket = None
 
+        # 调用方预先绑定好的业务socket，由调用方负责关闭
+        self._external_business_socket = business_socket
+
         # 文件传输组件
         self.file_receiver = file_receiver
         self.file_sender = file_sender
 
+        # 预分配的接收缓冲区池，避免每个报文分配新对象；
+        # 缓冲区在整批报文分发完成后才归还
+        self._rx_pool = BufferPool(65536, count=2)
+
+        # 报文突发时一次系统调用取出积压的多个报文；业务报文中的文件名
+        # 可能较长，使用更大的单报文缓冲区
+        self._broadcast_batch = BatchReceiver(count=32, size=2048)
+        self._business_batch = BatchReceiver(count=16, size=8192)
+
+        # 最近收到的广播报文摘要 {hash: 收到时间}，用于跳过重复报文
+        self._seen = {}
+        self._seen_evict_time = 0
+
+        # 唤醒socket对，stop()时写入一个字节让阻塞在select上的线程立即返回
+        self._wakeup_r = None
+        self._wakeup_w = None
+
         # 在初始化时检测local_port是否可用（用于端口检测）
         if neighbor_manager is None:  # 这是端口检测调用
             try:
@@ -41,21 +117,34 @@ class BroadcastListener:
         if self.running:
             return False
 
-        self.running = True
+        try:
+            self._wakeup_r, self._wakeup_w = socket.socketpair()
+            self._wakeup_r.setblocking(False)
+        except Exception as e:
+            print(f"[错误] 创建唤醒socket失败: {e}")
+            return False
 
-        # 启动广播监听
-        if not self._start_broadcast_listener(show_message):
+        # 打开广播监听socket
+        if not self._open_broadcast_socket(show_message):
+            self._close_wakeup()
             return False
 
-        # 启动业务监听
-        if not self._start_business_listener(show_message):
-            self._stop_broadcast_listener()
+        # 打开业务监听socket
+        if not self._open_business_socket(show_message):
+            self._close_socket(self.broadcast_socket)
+            self.broadcast_socket = None
+            self._close_wakeup()
             return False
 
+        # 单个反应器线程同时处理两个socket
+        self.running = True
+        self._reactor_thread = threading.Thread(
+            target=self._reactor_loop, daemon=True)
+        self._reactor_thread.start()
         return True
 
-    def _start_broadcast_listener(self, show_message=True):
-        """启动广播监听"""
+    def _open_broadcast_socket(self, show_message=True):
+        """创建并绑定广播监听socket"""
         try:
             # 创建UDP socket
             self.broadcast_socket = socket.socket(
@@ -64,30 +153,41 @@ class BroadcastListener:
                 socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 
             # 在支持的平台上设置SO_REUSEPORT，允许多个程序监听同一端口
-            try:
+            if _HAVE_REUSEPORT:
                 self.broadcast_socket.setsockopt(
                     socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
-            except (AttributeError, OSError):
-                pass  # 某些平台不支持SO_REUSEPORT
 
             # 绑定到广播端口，所有节点都监听这个端口
             self.broadcast_socket.bind(('', self.broadcast_port))
-            self.broadcast_socket.settimeout(1)  # 设置1秒超时
+            self._set_rcvbuf(self.broadcast_socket)
+            self._join_discovery_group(self.broadcast_socket)
+            self.broadcast_socket.setblocking(False)  # 由selector等待数据
 
             if show_message:
                 print(f"[信息] 广播监听器已启动，监听端口: {self.broadcast_port}")
-
-            self.broadcast_thread = threading.Thread(
-                target=self._broadcast_listen_loop, daemon=True)
-            self.broadcast_thread.start()
             return True
 
         except Exception as e:
             print(f"[错误] 启动广播监听器失败: {e}")
+            self._close_socket(self.broadcast_socket)
+            self.broadcast_socket = None
             return False
 
-    def _start_business_listener(self, show_message=True):
-        """启动业务监听"""
+    def _open_business_socket(self, show_message=True):
+        """创建并绑定业务监听socket"""
+        if self._external_business_socket is not None:
+            # 使用调用方已绑定并设置好缓冲区的socket
+            self.business_socket = self._external_business_socket
+            try:
+                self.business_socket.setblocking(False)
+            except Exception as e:
+                print(f"[错误] 启动业务监听器失败: {e}")
+                self.business_socket = None
+                return False
+            if show_message:
+                print(f"[信息] 业务监听器已启动，监听端口: {self.local_port}")
+            return True
+
         try:
             # 创建UDP socket监听业务端口
             self.business_socket = socket.socket(
@@ -96,26 +196,23 @@ class BroadcastListener:
                 socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 
             # 在支持的平台上设置SO_REUSEPORT
-            try:
+            if _HAVE_REUSEPORT:
                 self.business_socket.setsockopt(
                     socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
-            except (AttributeError, OSError):
-                pass
 
             # 绑定到业务端口
             self.business_socket.bind((self.local_ip, self.local_port))
-            self.business_socket.settimeout(1)  # 设置1秒超时
+            self._set_rcvbuf(self.business_socket)
+            self.business_socket.setblocking(False)  # 由selector等待数据
 
             if show_message:
                 print(f"[信息] 业务监听器已启动，监听端口: {self.local_port}")
-
-            self.business_thread = threading.Thread(
-                target=self._business_listen_loop, daemon=True)
-            self.business_thread.start()
             return True
 
         except Exception as e:
             print(f"[错误] 启动业务监听器失败: {e}")
+            self._close_socket(self.business_socket)
+            self.business_socket = None
             return False
 
     def stop(self, show_message=True):
@@ -126,118 +223,225 @@ class BroadcastListener:
         if show_message:
             print("[信息] 监听器已停止")
         self.running = False
+        self._wakeup()
 
-        self._stop_broadcast_listener()
-        self._stop_business_listener()
+        if self._reactor_thread and self._reactor_thread.is_alive():
+            self._reactor_thread.join(timeout=2)
 
-    def _stop_broadcast_listener(self):
-        """停止广播监听"""
-        if self.broadcast_socket:
+        self._close_socket(self.broadcast_socket)
+        if self.business_socket is not self._external_business_socket:
+            self._close_socket(self.business_socket)
+        self._close_wakeup()
+
+    @staticmethod
+    def _join_discovery_group(sock):
+        """加入节点发现组播组，失败时仍可通过全局广播发现节点"""
+        mreq = struct.pack('=4s4s', socket.inet_aton(DISCOVERY_MULTICAST_GROUP),
+                           socket.inet_aton('0.0.0.0'))
+        try:
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+        except OSError as e:
+            print(f"[警告] 加入组播组 {DISCOVERY_MULTICAST_GROUP} 失败: {e}")
+
+    @staticmethod
+    def _set_rcvbuf(sock):
+        """增大socket接收缓冲区，内核限制在rmem_max以内时打印警告"""
+        set_socket_buffers(sock, _RCVBUF_SIZE, send=False)
+
+    @staticmethod
+    def _close_socket(sock):
+        """关闭socket，忽略错误"""
+        if sock:
             try:
-                self.broadcast_socket.close()
+                sock.close()
             except:
                 pass
 
-        if self.broadcast_thread and self.broadcast_thread.is_alive():
-            self.broadcast_thread.join(timeout=2)
-
-    def _stop_business_listener(self):
-        """停止业务监听"""
-        if self.business_socket:
+    def _wakeup(self):
+        """唤醒阻塞在select上的反应器线程"""
+        if self._wakeup_w:
             try:
-                self.business_socket.close()
-            except:
+                self._wakeup_w.send(b'\0')
+            except OSError:
                 pass
 
-        if self.business_thread and self.business_thread.is_alive():
-            self.business_thread.join(timeout=2)
+    def _close_wakeup(self):
+        """关闭唤醒socket对"""
+        self._close_socket(self._wakeup_r)
+        self._close_socket(self._wakeup_w)
+        self._wakeup_r = None
+        self._wakeup_w = None
 
-    def _broadcast_listen_loop(self):
-        """广播监听循环"""
-        while self.running:
-            try:
-                data, addr = self.broadcast_socket.recvfrom(1024)
-                # 处理接收到的数据
-                self._handle_broadcast_message(data, addr)
-            except socket.timeout:
-                continue  # 超时继续等待
-            except Exception as e:
-                if not self.running:  # 如果是因为停止而导致的错误，忽略它
-                    break
-                print(f"[错误] 接收广播时出错: {e}")
-                time.sleep(1)  # 出错后等待一秒再继续
-
-    def _business_listen_loop(self):
-        """业务监听循环"""
-        while self.running:
-            try:
-                data, addr = self.business_socket.recvfrom(4096)
-                # 处理接收到的数据
-                self._handle_business_message(data, addr)
-            except socket.timeout:
-                continue  # 超时继续等待
-            except Exception as e:
-                if not self.running:  # 如果是因为停止而导致的错误，忽略它
-                    break
-                print(f"[错误] 业务监听时出错: {e}")
-                time.sleep(1)  # 出错后等待一秒再继续
+    def _reactor_loop(self):
+        """反应器循环：阻塞等待任一socket可读或停止信号，按来源分发"""
+        sel = selectors.DefaultSelector()
+        try:
+            sel.register(self.broadcast_socket, selectors.EVENT_READ,
+                         self._drain_broadcast_socket)
+            sel.register(self.business_socket, selectors.EVENT_READ,
+                         self._drain_business_socket)
+            sel.register(self._wakeup_r, selectors.EVENT_READ, None)
+        except Exception as e:
+            sel.close()
+            if self.running:
+                print(f"[错误] 启动监听循环失败: {e}")
+            return
+
+        try:
+            while self.running:
+                try:
+                    events = sel.select()
+                    if not self.running:
+                        break
+                    for key, _ in events:
+                        if key.data is not None:
+                            key.data(key.fileobj)
+                except Exception as e:
+                    if not self.running:  # 如果是因为停止而导致的错误，忽略它
+                        break
+                    print(f"[错误] 监听时出错: {e}")
+                    time.sleep(1)  # 出错后等待一秒再继续
+        finally:
+            sel.close()
+
+    def _drain_broadcast_socket(self, sock):
+        """取出广播socket中所有已到达的报文"""
+        self._drain_socket(sock, self._broadcast_batch,
+                           self._handle_broadcast_message)
+
+    def _drain_business_socket(self, sock):
+        """取出业务socket中所有已到达的报文"""
+        self._drain_socket(sock, self._business_batch,
+                           self._handle_business_message)
+
+    def _drain_socket(self, sock, batch, handle):
+        """取出socket中所有已到达的报文，逐个交给handle(data, addr)处理"""
+        rx_buf = self._rx_pool.acquire()
+        rx_view = memoryview(rx_buf)
+        try:
+            while self.running:
+                # 优先用recvmmsg一次取出多个报文
+                count = batch.recv(sock)
+                if count:
+                    for i in range(count):
+                        data, addr = batch.get(i)
+                        if data is not None:
+                            handle(data, addr)
+                    if count < batch.count:
+                        return
+                    continue
+
+                try:
+                    n, addr = sock.recvfrom_into(rx_buf)
+                except (BlockingIOError, InterruptedError):
+                    return  # 已取完
+                except ConnectionResetError:
+                    # Windows上发往离线节点的请求收到ICMP端口不可达后，下一次
+                    # 接收会报告WSAECONNRESET；与后续报文无关，继续接收
+                    continue
+                handle(rx_view[:n], addr)
+        finally:
+            rx_view.release()
+            self._rx_pool.release(rx_buf)
 
     def _handle_broadcast_message(self, data, addr):
         """处理接收到的广播消息"""
         try:
-            # 解析消息
-            message = Protocol.parse_message(data)
+            # 不是本协议的报文（其他程序的广播等）直接丢弃
+            if not self._is_known_broadcast(data):
+                return
+
+            # 自身发出的二进制发现帧会被内核回送，直接比较地址字段丢弃，
+            # 无需去重和解析。同机其他节点端口不同，不受影响
+            if (data[0] == _DISCOVERY_MAGIC and
+                    data[_ADDR_START:_ADDR_END] == self._self_addr):
+                return
+
+            # 同一报文在去重窗口内重复到达时直接丢弃，不再解析
+            if self._is_duplicate(data):
+                return
+
+            # 解析消息，首字节为魔数的是二进制发现帧，否则按JSON解析
+            if data[0] == _DISCOVERY_MAGIC:
+                message = _parse_discovery_frame(data)
+            else:
+                message = _parse_message(data)
             if not message:
                 return
 
             message_type = message.get('type')
 
             # 处理节点发现消息
-            if message_type == MessageType.NODE_DISCOVERY:
+            if message_type == _NODE_DISCOVERY:
                 self._handle_node_discovery(message, addr)
 
             # 处理文件传输请求
-            elif message_type == MessageType.SEND_OFFER:
+            elif message_type == _SEND_OFFER:
                 self._handle_file_offer(message, addr)
 
         except Exception as e:
             print(f"[错误] 处理广播消息时出错: {e}")
 
+    @staticmethod
+    def _is_known_broadcast(data):
+        """按首字节或消息前缀快速判断是否为本协议的广播报文"""
+        if not data:
+            return False
+        first = data[0]
+        if first == _DISCOVERY_MAGIC:
+            return True
+        if first != 0x7B:  # '{'
+            return False
+        for prefix in _BROADCAST_JSON_PREFIXES:
+            if data[:len(prefix)] == prefix:
+                return True
+        return False
+
+    def _is_duplicate(self, data):
+        """检查报文是否在去重窗口内已处理过"""
+        now = get_monotonic_ns()
+        seen = self._seen
+
+        # 每秒清理一次过期的摘要
+        if now - self._seen_evict_time >= _SEEN_EVICT_INTERVAL_NS:
+            expired = [h for h, t in seen.items() if now - t >= _DEDUP_WINDOW_NS]
+            for h in expired:
+                del seen[h]
+            self._seen_evict_time = now
+
+        h = hash(bytes(data))
+        last_seen = seen.get(h)
+        if last_seen is not None and now - last_seen < _DEDUP_WINDOW_NS:
+            return True
+        seen[h] = now
+        return False
+
     def _handle_node_discovery(self, message, addr):
         """处理节点发现消息"""
         node_ip = message.get('ip')
         node_port = message.get('port')
-        node_name = message.get('name', 'Unknown')
 
         if not node_ip or not node_port:
             return
 
-        # 防止自发现 - 忽略来自本机IP且端口相同的广播
-        if node_ip == self.local_ip and node_port == self.local_port:
+        try:
+            node_key = make_node_key(node_ip, node_port)
+        except (OSError, TypeError, ValueError, OverflowError):
             return
 
-        # 构造节点信息
-        node_info = {
-            'name': node_name,
-            'ip': node_ip,
-            'port': node_port,
-            'timestamp': int(float(message.get('timestamp', time.time()))),
-            'platform': message.get('platform', 'Unknown')  # 从消息中获取平台信息
-        }
-
-        # 生成节点键
-        node_key = f"{node_ip}:{node_port}"
-
-        # 检查是否是新节点
-        existing_neighbor = self.neighbor_manager.get_neighbor(node_key)
-        is_new_node = existing_neighbor is None
+        # 防止自发现 - 忽略来自本机IP且端口相同的广播
+        if node_key == self._self_key:
+            return
 
-        # 添加或更新邻居节点
-        success = self.neighbor_manager.add_or_update_neighbor(node_info)
+        # 接收时间由邻居管理器按本地单调时钟写入，无需转换消息中的时间戳
+        node_info = NodeInfo(node_ip, node_port,
+                             message.get('name', 'Unknown'),
+                             message.get('platform', 'Unknown'))
 
-        # 静默更新邻居节点信息，不显示发现消息
-        if success and is_new_node:
-            pass  # 新节点发现时不显示消息
+        # 静默添加或更新邻居节点，新节点发现时不显示消息
+        self.neighbor_manager.add_or_update_neighbor(node_info, node_key)
+        if self.discovery_event is not None:
+            self.discovery_event.set()
 
     def _handle_file_offer(self, message, addr):
         """处理文件传输请求"""
@@ -249,17 +453,17 @@ class BroadcastListener:
         """处理业务消息"""
         try:
             # 解析消息
-            message = Protocol.parse_message(data)
+            message = _parse_message(data)
             if not message:
                 return
 
             message_type = message.get('type')
 
             # 处理文件传输请求
-            if message_type == MessageType.SEND_OFFER:
+            if message_type == _SEND_OFFER:
                 self._handle_business_file_offer(message, addr)
             # 处理文件传输响应
-            elif message_type in [MessageType.RECEIVE_CONFIRM, MessageType.RECEIVE_REJECT]:
+            elif message_type in _FILE_RESPONSES:
                 self._handle_file_response(message, addr)
 
         except Exception as e:
@@ -285,6 +489,11 @@ class BroadcastListener:
         """设置文件发送器"""
         self.file_sender = file_sender
 
+    def set_file_handlers(self, file_receiver, file_sender):
+        """同时设置文件接收器和发送器，监听器运行中也可调用"""
+        self.file_receiver = file_receiver
+        self.file_sender = file_sender
+
     def is_running(self):
         """检查是否正在运行"""
         return self.running
@@ -3,17 +3,97 @@
 
 import sys
 import signal
-import argparse
+import types
 import time
 import platform
 import socket
 import os
-from utils import get_local_ip, generate_unique_node_name, find_available_port, is_port_available
+import errno
+import threading
+import queue
+from utils import (get_local_ip, generate_unique_node_name, find_available_port,
+                   is_port_available, set_socket_buffers, PORT_UNUSABLE_ERRNOS)
 from neighbors import NeighborManager
 from broadcast import BroadcastSender
 from listener import BroadcastListener
 from send_file import FileSender
-from recv_file import FileReceiver, input_lock, file_request_queue, process_file_request
+from recv_file import (FileReceiver, prompt_broker, file_request_queue,
+                       file_request_event, process_file_request)
+
+# 业务socket的收发缓冲区大小，突发传输时减少丢包
+_BUSINESS_BUFFER_SIZE = 8 * 1024 * 1024
+
+# 启动扫描最长等待时间（广播间隔1秒，确保能收到多次广播），以及发现
+# 第一个节点后继续等待其余节点的时间，保证自动生成的节点名称不重复
+_DISCOVERY_TIMEOUT = 3.0
+_DISCOVERY_GRACE = 0.3
+
+# 操作系统名称，运行期间不会变化
+_OS_NAME = platform.system()
+
+# 清屏并将光标移到左上角的ANSI转义序列
+_CLEAR_SCREEN = "\033[2J\033[H"
+
+# 启动横幅
+_BANNER = """
+╔══════════════════════════════════════════════════════════════╗
+║                                                              ║
+║   ██████╗ ██████╗ ██████╗     ███████╗██╗██╗     ███████╗    ║
+║   ██╔══██╗╚════██╗██╔══██╗    ██╔════╝██║██║     ██╔════╝    ║
+║   ██████╔╝ █████╔╝██████╔╝    █████╗  ██║██║     █████╗      ║
+║   ██╔═══╝ ██╔═══╝ ██╔═══╝     ██╔══╝  ██║██║     ██╔══╝      ║
+║   ██║     ███████╗██║         ██║     ██║███████╗███████╗    ║
+║   ╚═╝     ╚══════╝╚═╝         ╚═╝     ╚═╝╚══════╝╚══════╝    ║
+║                                                              ║
+║             ████████╗██████╗  █████╗ ███╗   ███╗             ║
+║             ╚══██╔══╝██╔══██╗██╔══██╗████╗ ████║             ║
+║                ██║   ██████╔╝███████║██╔████╔██║             ║
+║                ██║   ██╔══██╗██╔══██║██║╚██╔╝██║             ║
+║                ██║   ██║  ██║██║  ██║██║ ╚═╝ ██║             ║
+║                ╚═╝   ╚═╝  ╚═╝╚═╝  ╚═╝╚═╝     ╚═╝             ║
+║                                                              ║
+╚══════════════════════════════════════════════════════════════╝
+
+"""
+_BANNER_BYTES = _BANNER.encode('utf-8')
+
+# 命令行参数
+_VERSION = "P2P文件传输系统 v2.0 - 第二阶段"
+_OPTIONS = {
+    '-p': 'port', '--port': 'port',
+    '-b': 'broadcast_port', '--broadcast-port': 'broadcast_port',
+    '-n': 'name', '--name': 'name',
+}
+_USAGE = "usage: main.py [-h] [-p PORT] [-b PORT] [-n NAME] [--version]\n"
+_ARGS_HELP = """
+P2P文件传输系统 - 第二阶段
+
+options:
+  -h, --help            显示此帮助信息并退出
+  -p PORT, --port PORT  节点监听端口 (默认: 12000)
+  -b PORT, --broadcast-port PORT
+                        广播端口 (默认: 23333)
+  -n NAME, --name NAME  节点名称
+  --version             显示程序版本号并退出
+
+示例用法:
+  python main.py                    # 使用默认设置启动
+  python main.py -p 12001           # 指定业务端口端口，用来进行文件传输
+  python main.py -n "我的节点"      # 指定节点名称
+  python main.py -b 23334           # 指定广播端口，用来发现其他节点
+"""
+
+# 帮助信息
+_HELP_TEXT = """\
+可用命令:
+info    (i) - 显示节点信息和运行状态
+peers   (p) - 显示在线节点列表
+send    (s) - 发送文件到指定节点
+              用法: send <IP:端口|节点名称> <文件路径>
+clear   (c) - 清屏
+help    (h) - 显示本帮助信息
+quit    (q) - 退出程序
+"""
 
 
 class P2PNode:
@@ -26,39 +106,31 @@ class P2PNode:
         self.local_ip = get_local_ip()
         self.broadcast_port = broadcast_port
 
-        # 检查端口是否可用，如果不可用则自动寻找下一个可用端口
-        while True:
-            try:
-                # 创建一个实际的监听socket来测试端口
-                test_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-                test_socket.bind(('', port))
-                test_socket.close()
-                break  # 如果成功绑定，说明端口可用
-            except socket.error as e:
-                # 尝试下一个端口
-                port = port + 1
-
-        self.port = port
+        # 绑定业务端口，如果被占用则自动寻找下一个可用端口；
+        # 绑定成功的socket直接交给监听器使用，避免探测后再绑定的竞争
+        self._bind_business_socket(port)
 
         # 初始化组件
         self.neighbor_manager = NeighborManager()
 
-        # 创建并启动临时监听器来发现现有节点
+        # 创建并启动监听器来发现现有节点，扫描结束后继续作为节点的监听器运行
         print("[信息] 正在扫描网络中的节点...")
-        temp_listener = BroadcastListener(
+        discovery_event = threading.Event()
+        self.listener = BroadcastListener(
             self.neighbor_manager,
             self.local_ip,
             self.port,
-            self.broadcast_port
+            self.broadcast_port,
+            business_socket=self.business_socket,
+            discovery_event=discovery_event
         )
-        temp_listener.start(show_message=False)
+        self.listener.start(show_message=False)
 
-        # 等待足够的时间来发现节点（只监听，不发送广播）
+        # 等待发现节点（只监听，不发送广播）：收到第一个节点后再稍等片刻
+        # 收齐其余节点即可结束；网络中没有其他节点时最多等待3秒
         print("[信息] 正在等待发现其他节点...")
-        time.sleep(3)  # 3秒确保能收到多次广播（间隔1秒）
-
-        # 停止临时监听器（不显示停止消息）
-        temp_listener.stop(show_message=False)
+        if discovery_event.wait(timeout=_DISCOVERY_TIMEOUT):
+            time.sleep(_DISCOVERY_GRACE)
         print("[信息] 节点扫描完成")
 
         # 如果没有指定节点名称，根据已发现的节点生成唯一名称
@@ -75,6 +147,9 @@ class P2PNode:
         self.running = False
         self._start_time = time.time()
 
+        # 命令表：命令及其缩写映射到处理函数，处理函数统一接收cmd_parts
+        self._cmds = self._build_command_table()
+
         # 设置信号处理
         signal.signal(signal.SIGINT, self._signal_handler)
         signal.signal(signal.SIGTERM, self._signal_handler)
@@ -82,7 +157,9 @@ class P2PNode:
     def _init_network_components(self):
         """初始化网络组件"""
         # 初始化文件传输组件
-        self.file_sender = FileSender(self.local_ip, self.port)
+        # 推送请求经业务socket发出，对方的确认/拒绝由监听器在同一socket上收到
+        self.file_sender = FileSender(self.local_ip, self.port,
+                                      udp_socket=self.business_socket)
         self.file_receiver = FileReceiver(self.local_ip, self.port)
 
         # 初始化广播组件
@@ -92,14 +169,31 @@ class P2PNode:
             self.broadcast_port,
             node_name=self.node_name
         )
-        self.listener = BroadcastListener(
-            self.neighbor_manager,
-            self.local_ip,
-            self.port,
-            self.broadcast_port,
-            file_receiver=self.file_receiver,
-            file_sender=self.file_sender
-        )
+        # 扫描阶段的监听器继续使用，只需挂上文件传输处理器
+        self.listener.set_file_handlers(self.file_receiver, self.file_sender)
+
+    def _bind_business_socket(self, port):
+        """从port开始绑定第一个可用的业务端口，设置self.port和self.business_socket"""
+        while port <= 65535:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            # 显式关闭地址复用，端口已被其他节点占用时绑定会失败
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 0)
+            try:
+                sock.bind(('', port))
+            except OSError as e:
+                sock.close()
+                # 与端口检测使用同一组错误码，包括Windows上端口被独占时的WSAEACCES
+                if e.errno not in PORT_UNUSABLE_ERRNOS:
+                    raise
+                port += 1  # 尝试下一个端口
+                continue
+
+            set_socket_buffers(sock, _BUSINESS_BUFFER_SIZE)
+            self.business_socket = sock
+            self.port = port
+            return
+
+        raise OSError(errno.EADDRINUSE, "没有可用的业务端口")
 
     def start(self):
         """启动P2P节点"""
@@ -113,10 +207,13 @@ class P2PNode:
         # 启动广播发送器
         if not self.broadcaster.start():
             print("[错误] 启动广播发送器失败")
+            self.listener.stop()
             return False
 
-        # 启动统一监听器
-        if not self.listener.start():
+        # 统一监听器在扫描阶段已启动，扫描时启动失败则在此重试
+        if self.listener.is_running():
+            print(f"[信息] 监听器运行中，广播端口: {self.broadcast_port}，业务端口: {self.port}")
+        elif not self.listener.start():
             print("[错误] 启动监听器失败")
             self.broadcaster.stop()
             return False
@@ -144,6 +241,12 @@ class P2PNode:
         self.broadcaster.stop()
         self.listener.stop()
         self.neighbor_manager.stop()
+        self.file_sender.close()
+        self.file_receiver.close()
+        try:
+            self.business_socket.close()
+        except OSError:
+            pass
 
         print("[信息] 节点已停止")
 
@@ -155,25 +258,29 @@ class P2PNode:
 
     def _show_node_info(self):
         """显示本节点信息"""
-        print("节点信息")
-        print(f"名称: {self.node_name}")
-        print(f"本机地址: {self.local_ip}:{self.port}")
-        print(f"广播端口: {self.broadcast_port}")
-        print(f"操作系统: {platform.system()}")
-        print(f"运行时长: {self._get_uptime()}")
-        print()
-        print(f"[组件状态]")
-        print(
-            f"├─ 广播发送: {'✓ 运行中' if self.broadcaster.is_running() else '✗ 已停止'}")
-        print(f"├─ 广播监听: {'✓ 运行中' if self.listener.is_running() else '✗ 已停止'}")
-        print(f"└─ 在线邻居: {self.neighbor_manager.get_neighbor_count()} 个")
+        broadcaster_state = '✓ 运行中' if self.broadcaster.is_running() else '✗ 已停止'
+        listener_state = '✓ 运行中' if self.listener.is_running() else '✗ 已停止'
+        lines = [
+            "节点信息",
+            f"名称: {self.node_name}",
+            f"本机地址: {self.local_ip}:{self.port}",
+            f"广播端口: {self.broadcast_port}",
+            f"操作系统: {_OS_NAME}",
+            f"运行时长: {self._get_uptime()}",
+            "",
+            "[组件状态]",
+            f"├─ 广播发送: {broadcaster_state}",
+            f"├─ 广播监听: {listener_state}",
+            f"└─ 在线邻居: {self.neighbor_manager.get_neighbor_count()} 个",
+        ]
+        # 拼接后一次写出
+        sys.stdout.write("\n".join(lines) + "\n")
 
     def _get_uptime(self):
         """获取运行时长"""
         uptime = int(time.time() - self._start_time)
-        hours = uptime // 3600
-        minutes = (uptime % 3600) // 60
-        seconds = uptime % 60
+        minutes, seconds = divmod(uptime, 60)
+        hours, minutes = divmod(minutes, 60)
 
         if hours > 0:
             return f"{hours}小时 {minutes}分钟"
@@ -186,18 +293,11 @@ class P2PNode:
         """启动命令行界面"""
         while self.running:
             try:
-                # 检查是否有待处理的文件请求
-                try:
-                    request_data = file_request_queue.get_nowait()
-                    # 处理文件请求
-                    process_file_request(request_data)
-                    continue
-                except:
-                    pass  # 队列为空，继续正常命令处理
+                # 显示提示符前先处理所有待处理的文件请求
+                self._process_pending_requests()
 
                 print()  # 添加空行分隔
-                with input_lock:  # 使用输入锁确保独占性
-                    cmd_input = input("P2P> ").strip()
+                cmd_input = prompt_broker.ask("P2P> ").strip()
 
                 if not cmd_input:
                     continue
@@ -207,22 +307,12 @@ class P2PNode:
                 cmd = cmd_parts[0].lower()
 
                 # 执行命令
-                if cmd == 'help' or cmd == 'h':
-                    self._show_help()
-                elif cmd == 'info' or cmd == 'i':
-                    self._show_node_info()
-                elif cmd == 'peers' or cmd == 'p':
-                    print(self.neighbor_manager.format_neighbors_list())
-                elif cmd == 'clear' or cmd == 'c':
-                    self._clear_screen()
-                elif cmd == 'send' or cmd == 's':
-                    self._handle_send_command(cmd_parts)
-                elif cmd == 'quit' or cmd == 'q':
-                    self.stop()
-                    break
-                else:
+                handler = self._cmds.get(cmd)
+                if handler is None:
                     print(f"[错误] 未知命令: {cmd}")
                     print("[提示] 输入 'help' 查看可用命令")
+                    continue
+                handler(cmd_parts)
 
             except KeyboardInterrupt:
                 print("\n[信息] 收到中断信号，正在退出...")
@@ -231,6 +321,38 @@ class P2PNode:
             except Exception as e:
                 print(f"[错误] 命令执行出错: {e}")
 
+    def _build_command_table(self):
+        """构建命令名（含缩写）到处理函数的映射"""
+        commands = (
+            (('help', 'h'), lambda cmd_parts: self._show_help()),
+            (('info', 'i'), lambda cmd_parts: self._show_node_info()),
+            (('peers', 'p'), lambda cmd_parts: print(self.neighbor_manager.format_neighbors_list())),
+            (('clear', 'c'), lambda cmd_parts: self._clear_screen()),
+            (('send', 's'), self._handle_send_command),
+            (('quit', 'q'), lambda cmd_parts: self.stop()),  # stop()会结束命令循环
+        )
+        return {alias: handler for aliases, handler in commands for alias in aliases}
+
+    def _process_pending_requests(self):
+        """处理队列中所有待处理的文件请求"""
+        if not file_request_event.is_set():
+            return
+
+        # 先清除事件再取队列，取队列期间新入队的请求会重新置位
+        file_request_event.clear()
+        for request_data in self._drain_requests():
+            process_file_request(request_data)
+
+    @staticmethod
+    def _drain_requests():
+        """取出队列中全部待处理请求"""
+        items = []
+        while True:
+            try:
+                items.append(file_request_queue.get_nowait())
+            except queue.Empty:
+                return items
+
     def _handle_send_command(self, cmd_parts):
         """处理send命令"""
         if len(cmd_parts) < 3:
@@ -256,15 +378,11 @@ class P2PNode:
                 return
         else:
             # 节点名称格式 - 从在线节点中查找
-            found_node = None
-            for node_key, node_info in self.neighbor_manager.neighbors.items():
-                if node_info.get('name') == target:
-                    found_node = node_info
-                    target_ip, target_port = node_key.split(':')
-                    target_port = int(target_port)
-                    break
-
-            if not found_node:
+            _, found_node = self.neighbor_manager.get_neighbor_by_name(target)
+            if found_node:
+                target_ip = found_node.ip
+                target_port = int(found_node.port)
+            else:
                 print(f"[错误] 未找到节点 '{target}'")
                 print("[提示] 使用 'peers' 命令查看在线节点列表")
                 return
@@ -273,8 +391,7 @@ class P2PNode:
         node_key = f"{target_ip}:{target_port}"
         if not self.neighbor_manager.get_neighbor(node_key):
             print(f"[警告] 目标节点 {target} 不在在线节点列表中")
-            with input_lock:  # 使用输入锁
-                response = input("是否继续发送？(y/n): ").strip().lower()
+            response = prompt_broker.ask("是否继续发送？(y/n): ").strip().lower()
             if response not in ['y', 'yes', '是']:
                 print("[信息] 已取消发送")
                 return
@@ -302,86 +419,99 @@ class P2PNode:
 
     def _show_help(self):
         """显示帮助信息"""
-        print("可用命令:")
-        print("info    (i) - 显示节点信息和运行状态")
-        print("peers   (p) - 显示在线节点列表")
-        print("send    (s) - 发送文件到指定节点")
-        print("              用法: send <IP:端口|节点名称> <文件路径>")
-        print("clear   (c) - 清屏")
-        print("help    (h) - 显示本帮助信息")
-        print("quit    (q) - 退出程序")
+        sys.stdout.write(_HELP_TEXT)
         sys.stdout.flush()  # 强制刷新输出缓冲区
 
     def _clear_screen(self):
-        """清屏"""
-        import os
-        os.system('clear' if os.name == 'posix' else 'cls')
+        """清屏，直接输出ANSI转义序列，不再启动子进程"""
+        sys.stdout.write(_CLEAR_SCREEN)
+        sys.stdout.flush()
 
     def _print_banner(self):
         """打印程序启动横幅"""
-        banner = """
-╔══════════════════════════════════════════════════════════════╗
-║                                                              ║
-║   ██████╗ ██████╗ ██████╗     ███████╗██╗██╗     ███████╗    ║
-║   ██╔══██╗╚════██╗██╔══██╗    ██╔════╝██║██║     ██╔════╝    ║
-║   ██████╔╝ █████╔╝██████╔╝    █████╗  ██║██║     █████╗      ║
-║   ██╔═══╝ ██╔═══╝ ██╔═══╝     ██╔══╝  ██║██║     ██╔══╝      ║
-║   ██║     ███████╗██║         ██║     ██║███████╗███████╗    ║
-║   ╚═╝     ╚══════╝╚═╝         ╚═╝     ╚═╝╚══════╝╚══════╝    ║
-║                                                              ║
-║             ████████╗██████╗  █████╗ ███╗   ███╗             ║
-║             ╚══██╔══╝██╔══██╗██╔══██╗████╗ ████║             ║
-║                ██║   ██████╔╝███████║██╔████╔██║             ║
-║                ██║   ██╔══██╗██╔══██║██║╚██╔╝██║             ║
-║                ██║   ██║  ██║██║  ██║██║ ╚═╝ ██║             ║
-║                ╚═╝   ╚═╝  ╚═╝╚═╝  ╚═╝╚═╝     ╚═╝             ║
-║                                                              ║
-╚══════════════════════════════════════════════════════════════╝
-        """
-        print(banner)
-
+        buffer = getattr(sys.stdout, 'buffer', None)
+        encoding = (getattr(sys.stdout, 'encoding', None) or '').lower()
+        if buffer is None or encoding not in ('utf-8', 'utf8'):
+            # stdout被替换为不带底层缓冲区的对象（如IDE或测试环境），
+            # 或控制台不是UTF-8编码（如GBK），交给文本层按实际编码输出
+            sys.stdout.write(_BANNER)
+            return
+        sys.stdout.flush()  # 先写出文本层中已缓冲的内容，保证输出顺序
+        buffer.write(_BANNER_BYTES)
+        buffer.flush()
+
+
+def parse_arguments(argv=None):
+    """解析命令行参数
+
+    选项很少，直接遍历argv解析，避免导入和构造argparse的启动开销。
+    与argparse一样支持 "-p 12001"、"-p12001"、"--port 12001"、
+    "--port=12001"，以及无歧义的长选项前缀（如 "--po 12001"）
+    """
+    if argv is None:
+        argv = sys.argv[1:]
+
+    args = types.SimpleNamespace(port=12000, broadcast_port=23333, name=None)
+    i = 0
+    while i < len(argv):
+        arg = argv[i]
+        i += 1
+
+        if arg.startswith('--'):
+            option, has_value, value = arg.partition('=')
+            option = _match_long_option(option)
+        elif arg[:2] in _OPTIONS and len(arg) > 2:
+            # 短选项后直接跟值，如 "-p12001"
+            option, has_value, value = arg[:2], True, arg[2:]
+        else:
+            option, has_value, value = arg, False, ''
+
+        if option in ('-h', '--help'):
+            sys.stdout.write(_USAGE + _ARGS_HELP)
+            sys.exit(0)
+        if option == '--version':
+            sys.stdout.write(_VERSION + "\n")
+            sys.exit(0)
+
+        dest = _OPTIONS.get(option)
+        if dest is None:
+            _argument_error(f"无法识别的参数: {arg}")
+        if not has_value:
+            if i >= len(argv):
+                _argument_error(f"参数 {option} 需要一个值")
+            value = argv[i]
+            i += 1
+
+        if dest == 'name':
+            args.name = value
+        else:
+            try:
+                setattr(args, dest, int(value))
+            except ValueError:
+                _argument_error(f"参数 {option} 需要整数: '{value}'")
 
-def parse_arguments():
-    """解析命令行参数"""
-    parser = argparse.ArgumentParser(
-        description='P2P文件传输系统 - 第二阶段',
-        formatter_class=argparse.RawDescriptionHelpFormatter,
-        add_help=False,  # 禁用默认的-h选项
-        epilog="""
-示例用法:
-  python main.py                    # 使用默认设置启动
-  python main.py -p 12001           # 指定业务端口端口，用来进行文件传输
-  python main.py -n "我的节点"      # 指定节点名称
-  python main.py -b 23334           # 指定广播端口，用来发现其他节点
-        """
-    )
+    return args
 
-    # 手动添加中文帮助选项
-    parser.add_argument('-h', '--help',
-                        action='help',
-                        help='显示此帮助信息并退出')
 
-    parser.add_argument('-p', '--port',
-                        type=int,
-                        default=12000,
-                        help='节点监听端口 (默认: 12000)')
+# 可按前缀匹配的长选项
+_LONG_OPTIONS = tuple(option for option in _OPTIONS if option.startswith('--')) + (
+    '--help', '--version')
 
-    parser.add_argument('-b', '--broadcast-port',
-                        type=int,
-                        default=23333,
-                        metavar='PORT',
-                        help='广播端口 (默认: 23333)')
 
-    parser.add_argument('-n', '--name',
-                        type=str,
-                        help='节点名称')
+def _match_long_option(option):
+    """将长选项前缀展开为完整选项名，无法匹配时原样返回，有歧义时报错退出"""
+    if option in _LONG_OPTIONS:
+        return option
+    matches = [name for name in _LONG_OPTIONS if name.startswith(option)]
+    if len(matches) > 1:
+        _argument_error(f"参数 {option} 有歧义，可能是: {', '.join(matches)}")
+    return matches[0] if matches else option
 
-    parser.add_argument('--version',
-                        action='version',
-                        version='P2P文件传输系统 v2.0 - 第二阶段',
-                        help='显示程序版本号并退出')
 
-    return parser.parse_args()
+def _argument_error(message):
+    """输出用法和错误信息后退出，退出码与argparse一致"""
+    sys.stderr.write(f"{_USAGE}main.py: 错误: {message}\n")
+    sys.exit(2)
 
 
 def main():
@@ -389,6 +519,10 @@ def main():
     try:
         args = parse_arguments()
 
+        if os.name == 'nt':
+            # Windows 10+ 控制台执行一次空命令后即启用ANSI转义序列处理
+            os.system('')
+
         # 创建并启动P2P节点
         node = P2PNode(
             port=args.port,
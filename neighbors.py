@@ -1,17 +1,79 @@
 import threading
+import heapq
+import re
 import time
 import sys
-from utils import get_timestamp, format_time
+from utils import format_time, make_node_key, get_monotonic_ns as _now
+
+# 节点时间戳为单调时钟的整数纳秒
+_NS_PER_SEC = 1_000_000_000
+
+
+# 自动生成的节点名称格式 "node_N"
+_NODE_NAME_RE = re.compile(r'node_(\d+)\Z', re.ASCII)
+
+
+def _node_number(name):
+    """取出 "node_N" 格式名称中的编号N，其他名称返回None"""
+    match = _NODE_NAME_RE.match(name)
+    return int(match.group(1)) if match else None
+
+
+class NodeInfo:
+    """邻居节点信息
+
+    使用__slots__代替字典保存每个节点的字段，内存占用更小，属性访问更快
+    """
+
+    __slots__ = ('ip', 'port', 'name', 'platform', 'last_seen')
+
+    def __init__(self, ip, port, name='Unknown', platform='Unknown', last_seen=0):
+        self.ip = ip
+        self.port = port
+        self.name = name
+        self.platform = platform
+        self.last_seen = last_seen  # 最后心跳的单调时钟时间（纳秒）
+
+    @classmethod
+    def from_dict(cls, info):
+        """从节点信息字典创建"""
+        return cls(info.get('ip'), info.get('port'),
+                   info.get('name', 'Unknown'), info.get('platform', 'Unknown'))
+
+    def __repr__(self):
+        return (f"NodeInfo(ip={self.ip!r}, port={self.port!r}, "
+                f"name={self.name!r}, platform={self.platform!r})")
 
 
 class NeighborManager:
     """邻居节点管理器"""
 
     def __init__(self, timeout_seconds=10):
-        self.neighbors = {}  # {ip:port: node_info}
-        self.lock = threading.Lock()
+        # {整数节点键: node_info}，见utils.make_node_key
+        # 写时复制：增删节点时整体替换字典，读操作直接读取当前引用，无需加锁；
+        # 已有节点的心跳更新只替换值，不改变字典大小，迭代中的读者不受影响
+        self.neighbors = {}
+        self._name_to_key = {}  # {节点名称: 节点键}，按名称查找节点的索引
+        # {节点名称: 使用该名称的节点键集合}，仅由写操作维护，名称重复时
+        # 据此让索引改指向另一个同名节点，无需遍历全部节点
+        self._name_keys = {}
+        self.lock = threading.Lock()  # 仅用于写操作之间的互斥
         self.timeout_seconds = timeout_seconds
+        self._timeout_ns = int(timeout_seconds * _NS_PER_SEC)
         self._running = True
+        self._stop_event = threading.Event()
+
+        # 过期时间最小堆 [(过期时间（纳秒）, 节点键), ...]，每个节点只在加入时压入一项；
+        # 弹出时节点仍有心跳则按最新心跳时间重新压入，心跳本身不操作堆
+        self._expiry_heap = []
+        self._scheduled_keys = set()  # 在堆中有表项的节点键，避免重复压入
+
+        # "node_N" 名称编号的使用情况，用于生成最小的未使用编号：
+        # _used_node_nums为 {编号: 使用该编号的节点数}；小于_next_node_num
+        # 的编号释放后压入_free_node_nums堆，取用时再核对是否仍未使用
+        self._used_node_nums = {}
+        self._free_node_nums = []
+        self._next_node_num = 1
 
         # 启动清理线程
         self.cleanup_thread = threading.Thread(
@@ -20,121 +82,245 @@ class NeighborManager:
 
     def _get_node_key(self, node_info):
         """生成节点的唯一标识符"""
-        ip = node_info.get('ip')
-        port = node_info.get('port')
+        ip = node_info.ip
+        port = node_info.port
         if not ip or not port:
             return None
-        return f"{ip}:{port}"
+        try:
+            return make_node_key(ip, port)
+        except (OSError, TypeError, ValueError, OverflowError):
+            return None
+
+    @staticmethod
+    def _normalize_key(node_key):
+        """将 "ip:port" 字符串键转换为整数键，整数键原样返回"""
+        if isinstance(node_key, int):
+            return node_key
+        try:
+            ip, port = str(node_key).rsplit(':', 1)
+            return make_node_key(ip, port)
+        except (OSError, TypeError, ValueError, OverflowError):
+            return None
+
+    def add_or_update_neighbor(self, node_info, node_key=None):
+        """添加或更新邻居节点
 
-    def add_or_update_neighbor(self, node_info):
-        """添加或更新邻居节点"""
-        node_key = self._get_node_key(node_info)
-        if not node_key:
+        node_info可以是NodeInfo或节点信息字典；调用方已计算出整数节点键时
+        可通过node_key传入，避免重复计算
+        """
+        if not isinstance(node_info, NodeInfo):
+            node_info = NodeInfo.from_dict(node_info)
+        if node_key is None:
+            node_key = self._get_node_key(node_info)
+        if node_key is None:
             return False
 
         with self.lock:
-            # 更新时间戳
-            node_info['timestamp'] = get_timestamp()
-            self.neighbors[node_key] = node_info
+            # 记录本地接收时间；使用单调时钟，系统时间被调整时不会误判过期
+            node_info.last_seen = _now()
+            old_info = self.neighbors.get(node_key)
+            if old_info is None:
+                self.neighbors = {**self.neighbors, node_key: node_info}
+                self._index_name(node_key, node_info)
+            else:
+                if old_info.name != node_info.name:
+                    self._unindex_name(node_key, old_info)
+                    self._index_name(node_key, node_info)
+                self.neighbors[node_key] = node_info
+            self._name_to_key[node_info.name] = node_key
+            # 新节点的过期时间不早于堆中任何表项，无需唤醒清理线程
+            if node_key not in self._scheduled_keys:
+                self._scheduled_keys.add(node_key)
+                heapq.heappush(self._expiry_heap,
+                               (node_info.last_seen + self._timeout_ns, node_key))
             return True
 
+    def _index_name(self, node_key, node_info):
+        """登记新节点或改名节点的名称，调用方需持有锁"""
+        self._name_keys.setdefault(node_info.name, set()).add(node_key)
+        self._use_node_num(node_info.name)
+
+    def _unindex_name(self, node_key, node_info):
+        """从名称索引中移除节点，调用方需持有锁"""
+        name = node_info.name
+        self._release_node_num(name)
+        keys = self._name_keys.get(name)
+        if keys is not None:
+            keys.discard(node_key)
+            if not keys:
+                del self._name_keys[name]
+        if self._name_to_key.get(name) != node_key:
+            return
+
+        # 名称重复时让索引指向另一个同名节点
+        if keys:
+            self._name_to_key[name] = next(iter(keys))
+        else:
+            del self._name_to_key[name]
+
     def remove_neighbor(self, node_key):
         """移除邻居节点"""
+        node_key = self._normalize_key(node_key)
         with self.lock:
-            if node_key in self.neighbors:
-                del self.neighbors[node_key]
-                return True
-            return False
+            if node_key not in self.neighbors:
+                return False
+            self._remove_keys((node_key,))
+            return True
 
-    def get_neighbor(self, node_key):
-        """获取特定邻居节点信息"""
+    def _remove_keys(self, node_keys):
+        """替换为不含node_keys的新字典并更新名称索引，调用方需持有锁"""
+        old_neighbors = self.neighbors
+        removed = set(node_keys)
+        self.neighbors = {key: info for key, info in old_neighbors.items()
+                          if key not in removed}
+        for node_key in removed:
+            self._unindex_name(node_key, old_neighbors[node_key])
+
+    def _use_node_num(self, name):
+        """登记节点名称中的编号，调用方需持有锁"""
+        num = _node_number(name)
+        if num is not None:
+            self._used_node_nums[num] = self._used_node_nums.get(num, 0) + 1
+
+    def _release_node_num(self, name):
+        """释放节点名称中的编号，调用方需持有锁"""
+        num = _node_number(name)
+        count = self._used_node_nums.get(num)
+        if count is None:
+            return
+        if count > 1:
+            self._used_node_nums[num] = count - 1
+            return
+        del self._used_node_nums[num]
+        if 0 < num < self._next_node_num:
+            heapq.heappush(self._free_node_nums, num)
+
+    def next_free_node_number(self):
+        """返回 "node_N" 名称中最小的未使用编号N（从1开始）"""
         with self.lock:
-            return self.neighbors.get(node_key, None)
+            used = self._used_node_nums
+            free = self._free_node_nums
+            # 丢弃释放后又被占用的编号
+            while free and free[0] in used:
+                heapq.heappop(free)
+            while self._next_node_num in used:
+                self._next_node_num += 1
+            if free and free[0] < self._next_node_num:
+                return free[0]
+            return self._next_node_num
+
+    def get_neighbor(self, node_key):
+        """获取特定邻居节点信息，node_key可以是整数键或 "ip:port" 字符串"""
+        node_key = self._normalize_key(node_key)
+        return self.neighbors.get(node_key, None)
+
+    def get_neighbor_by_name(self, name):
+        """按名称查找邻居节点，返回 (节点键, 节点信息)，未找到返回 (None, None)"""
+        node_key = self._name_to_key.get(name)
+        if node_key is None:
+            return None, None
+        return node_key, self.neighbors.get(node_key)
+
+    def get_all_names(self):
+        """获取所有邻居节点名称（重名节点只出现一次），直接读取名称索引，不遍历节点"""
+        return list(self._name_to_key)
 
     def get_all_neighbors(self):
         """获取所有邻居节点信息"""
-        with self.lock:
-            # 返回副本，避免外部修改
-            return dict(self.neighbors)
+        # 返回副本，避免外部修改
+        return dict(self.neighbors)
 
     def get_neighbor_count(self):
         """获取邻居节点数量"""
-        with self.lock:
-            return len(self.neighbors)
+        return len(self.neighbors)
 
     def is_neighbor_online(self, node_key):
         """检查邻居节点是否在线"""
-        with self.lock:
-            if node_key not in self.neighbors:
-                return False
+        node_key = self._normalize_key(node_key)
+        node_info = self.neighbors.get(node_key)
+        if node_info is None:
+            return False
 
-            node_info = self.neighbors[node_key]
-            current_time = get_timestamp()
-            last_seen = node_info.get('timestamp', 0)
-            return (current_time - last_seen) <= self.timeout_seconds
+        return (_now() - node_info.last_seen) <= self._timeout_ns
 
     def _cleanup_expired_nodes(self):
-        """清理过期节点的后台线程"""
+        """清理过期节点的后台线程
+
+        按过期时间堆休眠到最近一个节点的过期时刻，stop()可立即唤醒
+        """
         while self._running:
             try:
-                current_time = get_timestamp()
-                expired_keys = []
-
                 with self.lock:
-                    for node_key, node_info in self.neighbors.items():
-                        last_seen = node_info.get('timestamp', 0)
-                        if (current_time - last_seen) > self.timeout_seconds:
-                            expired_keys.append(
-                                (node_key, node_info.get('name', node_key)))
+                    current_time = _now()
+                    heap = self._expiry_heap
+                    expired_keys = []
+                    while heap and heap[0][0] < current_time:
+                        _, node_key = heapq.heappop(heap)
+                        node_info = self.neighbors.get(node_key)
+                        if node_info is None:
+                            self._scheduled_keys.discard(node_key)
+                            continue
+                        if (current_time - node_info.last_seen) > self._timeout_ns:
+                            self._scheduled_keys.discard(node_key)
+                            expired_keys.append(node_key)
+                        else:
+                            # 期间收到过心跳，按最新心跳时间重新登记
+                            heapq.heappush(heap, (node_info.last_seen + self._timeout_ns,
+                                                  node_key))
+                    if expired_keys:
+                        self._remove_keys(expired_keys)
 
-                # 在锁外删除过期节点
-                for node_key, node_name in expired_keys:
-                    with self.lock:
-                        if node_key in self.neighbors:
-                            del self.neighbors[node_key]
+                    # 堆为空时新节点最早也要timeout_seconds后才过期
+                    if heap:
+                        wait_time = (heap[0][0] - current_time) / _NS_PER_SEC
+                    else:
+                        wait_time = self.timeout_seconds
 
-                # 每5秒检查一次
-                time.sleep(5)
+                self._stop_event.wait(wait_time)
 
             except Exception as e:
                 print(f"[错误] 清理过期节点时发生错误: {e}")
-                time.sleep(5)
+                self._stop_event.wait(5)
+
+    def snapshot_rows(self):
+        """提取显示所需字段，返回 [(名称, IP, 端口, 时间戳, 平台), ...]
+
+        时间戳为最后心跳对应的系统时间，由单调时钟的接收时间换算得到
+        """
+        wall_offset = time.time_ns() - _now()
+        return [(ni.name, ni.ip, ni.port, (ni.last_seen + wall_offset) / _NS_PER_SEC,
+                 ni.platform)
+                for ni in self.neighbors.values()]
 
     def format_neighbors_list(self):
         """格式化邻居列表为显示字符串"""
-        neighbors = self.get_all_neighbors()
+        rows = self.snapshot_rows()
 
-        lines = []
-        lines.append("在线节点列表:")
-        lines.append(
-            f"{'节点名称':<15} {'IP地址':<15} {'端口':<8} {'最后心跳':<12} {'平台':<10}")
-        lines.append("-" * 62)
+        lines = [
+            "在线节点列表:",
+            f"{'节点名称':<15} {'IP地址':<15} {'端口':<8} {'最后心跳':<12} {'平台':<10}",
+            "-" * 62,
+        ]
 
-        if not neighbors:
+        if not rows:
             lines.append("当前没有发现其他在线节点")
             lines.append("-" * 62)
             lines.append("总计: 0 个节点在线")
             return "\n".join(lines)
 
-        for node_key, node_info in neighbors.items():
-            name = node_info.get('name', 'Unknown')
-            ip = node_info.get('ip', 'N/A')
-            port = node_info.get('port', 'N/A')
-            timestamp = node_info.get('timestamp', 0)
-            platform_info = node_info.get('platform', 'Unknown')
-            last_seen = format_time(timestamp)
-
-            lines.append(
-                f"{name:<15} {ip:<15} {port:<8} {last_seen:<12} {platform_info:<10}")
+        lines.extend(
+            f"{name:<15} {ip:<15} {port:<8} {format_time(timestamp):<12} {platform_info:<10}"
+            for name, ip, port, timestamp, platform_info in rows)
 
         lines.append("-" * 62)
-        lines.append(f"总计: {len(neighbors)} 个节点在线")
+        lines.append(f"总计: {len(rows)} 个节点在线")
 
         return "\n".join(lines)
 
     def stop(self):
         """停止邻居管理器"""
         self._running = False
+        self._stop_event.set()
         if hasattr(self, 'cleanup_thread') and self.cleanup_thread.is_alive():
             self.cleanup_thread.join(timeout=1)
 
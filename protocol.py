@@ -6,8 +6,99 @@
 
 import json
 import hashlib
+import mmap
 import os
-from typing import Dict, Any, Optional
+import platform
+import re
+import socket
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, Optional, Tuple, Union
+
+# 可选依赖：orjson直接输出UTF-8字节串并接受bytes/memoryview输入，
+# 比标准库json快数倍，未安装时使用json
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# 可选依赖：blake3支持多线程哈希，速度远高于MD5，
+# 未安装时只能使用MD5校验
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+
+def json_dumps(message: Dict[str, Any]) -> bytes:
+    """将消息序列化为UTF-8编码的JSON字节串，全部模块共用这一个实现
+
+    未安装orjson时按与orjson相同的紧凑格式输出，报文格式与是否安装orjson无关
+    """
+    if orjson is not None:
+        return orjson.dumps(message)
+    return json.dumps(message, ensure_ascii=False,
+                      separators=(',', ':')).encode('utf-8')
+
+
+def json_loads(data: Union[bytes, bytearray, memoryview]) -> Any:
+    """解析UTF-8编码的JSON字节串，格式错误时抛出ValueError"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(str(data, 'utf-8'))
+
+
+class _MD5X8:
+    """8路并行MD5，协商名称为 "md5x8-1m"
+
+    本项目自定义的摘要，与其他实现的并行MD5不兼容。定义：文件按1 MiB
+    (_STRIPE字节) 切成条带，最后一个条带可以不满；第k个条带（从0开始）
+    依次追加到第k % 8路MD5，没有数据的路保持初始状态；最终摘要是8路
+    16字节摘要按路的顺序拼接后的MD5，以32位小写十六进制表示。
+
+    各路互不依赖，整个文件映射到内存时由8个线程并行计算（hashlib在计算
+    大块数据时释放GIL），结果与顺序update一致
+    """
+
+    LANES = 8
+    _STRIPE = 1 << 20
+
+    def __init__(self):
+        self._lanes = [hashlib.md5() for _ in range(self.LANES)]
+        self._pos = 0  # 已处理的字节数
+
+    def update(self, data) -> None:
+        """顺序追加数据，按当前位置分配到对应的路"""
+        view = memoryview(data).cast('B')
+        stripe = self._STRIPE
+        while view:
+            take = stripe - self._pos % stripe
+            lane = self._lanes[(self._pos // stripe) % self.LANES]
+            lane.update(view[:take])
+            taken = min(take, len(view))
+            view = view[taken:]
+            self._pos += taken
+
+    def update_parallel(self, view: memoryview) -> None:
+        """多线程计算尚未处理过数据的对象，view为整个文件的内容"""
+        size = len(view)
+        stride = self._STRIPE * self.LANES
+        if self._pos or size <= self._STRIPE:
+            self.update(view)
+            return
+
+        def hash_lane(index):
+            lane = self._lanes[index]
+            for offset in range(index * self._STRIPE, size, stride):
+                lane.update(view[offset:offset + self._STRIPE])
+
+        with ThreadPoolExecutor(max_workers=min(self.LANES, os.cpu_count() or 1)) as pool:
+            list(pool.map(hash_lane, range(self.LANES)))
+        self._pos = size
+
+    def hexdigest(self) -> str:
+        return hashlib.md5(b''.join(lane.digest() for lane in self._lanes)).hexdigest()
 
 
 class MessageType:
@@ -31,19 +122,105 @@ class Protocol:
 
     BLOCK_SIZE = 64 * 1024  # 64KB 分块大小
 
+    # 文件校验算法，按优先顺序排列；MD5始终可用，用于兼容旧版本节点
+    HASH_MD5 = "md5"
+    HASH_MD5X8 = "md5x8-1m"  # 本项目定义的8路并行MD5，1 MiB条带，见_MD5X8
+    HASH_BLAKE3 = "blake3"
+    SUPPORTED_HASH_ALGS = ((HASH_BLAKE3, HASH_MD5X8, HASH_MD5) if blake3 is not None
+                           else (HASH_MD5X8, HASH_MD5))
+
+    # 二进制节点发现帧: 魔数、版本、时间戳、IP、端口、名称长度、平台长度，
+    # 其后紧跟UTF-8编码的名称和平台字符串。魔数不是合法的JSON起始字节，
+    # 接收方据此区分二进制帧和JSON消息
+    DISCOVERY_MAGIC = 0xB7
+    DISCOVERY_VERSION = 1
+    DISCOVERY_HEADER = struct.Struct('!BBI4sHBB')
+    DISCOVERY_TIMESTAMP = struct.Struct('!I')
+    DISCOVERY_TIMESTAMP_OFFSET = 2
+    DISCOVERY_ADDR_OFFSET = 6   # IP(4字节)和端口(2字节)在帧中的起始位置
+    DISCOVERY_ADDR_SIZE = 6
+
     @staticmethod
     def create_discovery_message(node_name: str, node_ip: str, node_port: int) -> bytes:
         """创建节点发现消息"""
-        import platform as platform_module
+        prefix, suffix = Protocol.create_discovery_template(
+            node_name, node_ip, node_port)
+        return prefix + str(int(time.time())).encode('ascii') + suffix
+
+    @staticmethod
+    def create_discovery_template(node_name: str, node_ip: str,
+                                  node_port: int) -> Tuple[bytes, bytes]:
+        """创建节点发现消息模板
+
+        返回时间戳字段前后的两段字节，发送时只需拼接当前时间戳，
+        结果与完整序列化的消息一致
+        """
         message = {
             "type": MessageType.NODE_DISCOVERY,
             "name": node_name,
             "ip": node_ip,
             "port": node_port,
-            "platform": platform_module.system(),
-            "timestamp": str(int(__import__('time').time()))
+            "platform": platform.system()
         }
-        return json.dumps(message, ensure_ascii=False).encode('utf-8')
+        # 去掉结尾的 '}'，在最后追加整数timestamp字段
+        head = json.dumps(message, ensure_ascii=False)[:-1]
+        prefix = (head + ', "timestamp": ').encode('utf-8')
+        return prefix, b'}'
+
+    @staticmethod
+    def create_discovery_frame(node_name: str, node_ip: str, node_port: int) -> bytearray:
+        """创建二进制节点发现帧
+
+        时间戳字段位于DISCOVERY_TIMESTAMP_OFFSET处，发送方可复用同一个
+        bytearray，每次发送前用DISCOVERY_TIMESTAMP.pack_into写入当前时间
+        """
+        name = Protocol._encode_short_str(node_name)
+        platform_name = Protocol._encode_short_str(platform.system())
+        header = Protocol.DISCOVERY_HEADER.pack(
+            Protocol.DISCOVERY_MAGIC, Protocol.DISCOVERY_VERSION,
+            int(time.time()), socket.inet_aton(node_ip), node_port,
+            len(name), len(platform_name))
+        return bytearray(header + name + platform_name)
+
+    @staticmethod
+    def pack_discovery_addr(node_ip: str, node_port: int) -> bytes:
+        """返回发现帧中IP和端口字段的原始字节，用于不解析整帧直接比较来源"""
+        return socket.inet_aton(node_ip) + node_port.to_bytes(2, 'big')
+
+    @staticmethod
+    def parse_discovery_frame(data: Union[bytes, bytearray, memoryview]) -> Optional[Dict[str, Any]]:
+        """解析二进制节点发现帧，格式不正确时返回None"""
+        header = Protocol.DISCOVERY_HEADER
+        if len(data) < header.size:
+            return None
+        try:
+            (magic, version, timestamp, ip, port,
+             name_len, platform_len) = header.unpack_from(data)
+            if magic != Protocol.DISCOVERY_MAGIC or version != Protocol.DISCOVERY_VERSION:
+                return None
+            name_end = header.size + name_len
+            platform_end = name_end + platform_len
+            if len(data) < platform_end:
+                return None
+            return {
+                "type": MessageType.NODE_DISCOVERY,
+                "name": str(data[header.size:name_end], 'utf-8'),
+                "ip": socket.inet_ntoa(ip),
+                "port": port,
+                "platform": str(data[name_end:platform_end], 'utf-8'),
+                "timestamp": timestamp
+            }
+        except (struct.error, UnicodeDecodeError) as e:
+            print(f"[错误] 节点发现帧解析失败: {e}")
+            return None
+
+    @staticmethod
+    def _encode_short_str(value: str) -> bytes:
+        """编码为不超过255字节的UTF-8，截断时不拆分多字节字符"""
+        encoded = value.encode('utf-8')
+        if len(encoded) > 255:
+            encoded = encoded[:255].decode('utf-8', 'ignore').encode('utf-8')
+        return encoded
 
     @staticmethod
     def create_send_offer(sender_ip: str, sender_port: int, file_path: str,
@@ -56,41 +233,68 @@ class Protocol:
             "file_name": os.path.basename(file_path),
             "file_size": file_size,
             "file_md5": file_md5,
+            "hash_algs": list(Protocol.SUPPORTED_HASH_ALGS),
             "timestamp": str(int(__import__('time').time()))
         }
-        return json.dumps(message, ensure_ascii=False).encode('utf-8')
+        return json_dumps(message)
+
+    @staticmethod
+    def choose_hash_alg(offered_algs: Optional[Any]) -> str:
+        """从对方支持的校验算法中选出本机也支持的首选算法
+
+        旧版本节点不携带算法列表，此时使用MD5
+        """
+        if isinstance(offered_algs, (list, tuple)):
+            for alg in Protocol.SUPPORTED_HASH_ALGS:
+                if alg in offered_algs:
+                    return alg
+        return Protocol.HASH_MD5
+
+    # 拒绝消息不含可变字段，只序列化一次
+    _REJECT_MESSAGE = json_dumps({"type": MessageType.RECEIVE_REJECT})
 
     @staticmethod
-    def create_receive_response(accepted: bool, receiver_port: Optional[int] = None) -> bytes:
-        """创建接收响应消息"""
-        message_type = MessageType.RECEIVE_CONFIRM if accepted else MessageType.RECEIVE_REJECT
+    def create_receive_response(accepted: bool, receiver_port: Optional[int] = None,
+                                hash_alg: Optional[str] = None) -> bytes:
+        """创建接收响应消息，hash_alg为接收方选定的文件校验算法"""
+        if not accepted:
+            return Protocol._REJECT_MESSAGE
         message = {
-            "type": message_type,
+            "type": MessageType.RECEIVE_CONFIRM,
             "timestamp": str(int(__import__('time').time()))
         }
-        if accepted and receiver_port:
+        if receiver_port:
             message["tcp_port"] = receiver_port
-        return json.dumps(message, ensure_ascii=False).encode('utf-8')
+        if hash_alg:
+            message["hash_alg"] = hash_alg
+        return json_dumps(message)
 
     @staticmethod
-    def create_file_meta(file_name: str, total_blocks: int) -> bytes:
-        """创建文件元信息消息"""
+    def create_file_meta(file_name: str, total_blocks: int, file_size: int) -> bytes:
+        """创建文件元信息消息
+
+        元信息之后紧跟file_size字节的原始文件内容，数据块不再带长度前缀
+        """
         message = {
             "type": MessageType.FILE_META,
             "file_name": file_name,
+            "file_size": file_size,
             "total_blocks": total_blocks,
             "block_size": Protocol.BLOCK_SIZE
         }
-        return json.dumps(message, ensure_ascii=False).encode('utf-8')
+        return json_dumps(message)
+
+    # ACK和传输完成消息只有个别字段会变化，预先生成其余部分的字节，
+    # 创建时直接拼接，结果仍是合法的JSON
+    _ACK_PREFIX = b'{"type":"' + MessageType.ACK.encode('ascii') + b'","block_number":'
+    _COMPLETE_PREFIX = (b'{"type":"' + MessageType.TRANSFER_COMPLETE.encode('ascii')
+                        + b'","hash_alg":"')
+    _COMPLETE_MIDDLE = b'","timestamp":"'
 
     @staticmethod
     def create_ack(block_number: int) -> bytes:
         """创建确认消息"""
-        message = {
-            "type": MessageType.ACK,
-            "block_number": block_number
-        }
-        return json.dumps(message, ensure_ascii=False).encode('utf-8')
+        return b'%s%d}' % (Protocol._ACK_PREFIX, block_number)
 
     @staticmethod
     def create_error(error_msg: str) -> bytes:
@@ -100,52 +304,223 @@ class Protocol:
             "error": error_msg,
             "timestamp": str(int(__import__('time').time()))
         }
-        return json.dumps(message, ensure_ascii=False).encode('utf-8')
+        return json_dumps(message)
 
     @staticmethod
-    def create_transfer_complete(file_md5: str) -> bytes:
-        """创建传输完成消息"""
-        message = {
-            "type": MessageType.TRANSFER_COMPLETE,
-            "file_md5": file_md5,
-            "timestamp": str(int(__import__('time').time()))
-        }
-        return json.dumps(message, ensure_ascii=False).encode('utf-8')
+    def create_transfer_complete(file_hash: str, hash_alg: str = HASH_MD5) -> bytes:
+        """创建传输完成消息，file_hash为十六进制摘要字符串
+
+        MD5摘要仍放在file_md5字段中，旧版本节点可以直接校验；
+        其他算法的摘要放在file_hash字段中
+        """
+        field = b'file_md5' if hash_alg == Protocol.HASH_MD5 else b'file_hash'
+        return b'%s%s","%s":"%s%s%d"}' % (
+            Protocol._COMPLETE_PREFIX, hash_alg.encode('ascii'), field,
+            file_hash.encode('ascii'), Protocol._COMPLETE_MIDDLE, int(time.time()))
+
+    # 不解析JSON直接读取type字段，兼容json与orjson的两种分隔符写法
+    _TYPE_PATTERN = re.compile(rb'"type"\s*:\s*"([^"\\]*)"')
+    _BLOCK_NUMBER_PATTERN = re.compile(rb'"block_number"\s*:\s*(\d+)')
+
+    @staticmethod
+    def peek_type(data: Union[bytes, bytearray, memoryview]) -> Optional[str]:
+        """只读取消息的type字段，不做完整的JSON解析，找不到时返回None
+
+        用于在解析前快速判断消息类型，类型不符的消息无需解码和解析
+        """
+        match = Protocol._TYPE_PATTERN.search(data)
+        if match is None:
+            return None
+        return match.group(1).decode('ascii', 'replace')
 
     @staticmethod
-    def parse_message(data: bytes) -> Optional[Dict[str, Any]]:
-        """解析消息"""
+    def parse_ack(data: Union[bytes, bytearray, memoryview]) -> Optional[int]:
+        """解析确认消息，返回块号；不是确认消息时返回None"""
+        if Protocol.peek_type(data) != MessageType.ACK:
+            return None
+        match = Protocol._BLOCK_NUMBER_PATTERN.search(data)
+        return int(match.group(1)) if match else None
+
+    @staticmethod
+    def parse_message(data: Union[bytes, bytearray, memoryview]) -> Optional[Dict[str, Any]]:
+        """解析消息，支持直接传入接收缓冲区的memoryview"""
         try:
-            message_str = data.decode('utf-8')
-            return json.loads(message_str)
-        except (UnicodeDecodeError, json.JSONDecodeError) as e:
+            return json_loads(data)
+        except (TypeError, ValueError) as e:  # 包括UnicodeDecodeError和JSONDecodeError
             print(f"[错误] 消息解析失败: {e}")
             return None
 
+    # TCP消息帧的长度前缀
+    FRAME_HEADER = struct.Struct('!I')
+
+    @staticmethod
+    def send_frame(sock: socket.socket, message: bytes) -> None:
+        """发送带4字节长度前缀的消息帧
+
+        支持sendmsg的平台上用一次分散写同时发出长度和消息，不再拼接新的字节串
+        """
+        header = Protocol.FRAME_HEADER.pack(len(message))
+        if not hasattr(sock, 'sendmsg'):
+            sock.sendall(header + message)
+            return
+        sent = sock.sendmsg([header, message])
+        if sent < len(header) + len(message):
+            # 发送缓冲区不足时补发剩余部分
+            sock.sendall((header + message)[sent:])
+
+    @staticmethod
+    def recv_frame(sock: socket.socket) -> bytearray:
+        """接收一个带4字节长度前缀的消息帧，返回消息内容"""
+        header = Protocol.recv_exact(sock, Protocol.FRAME_HEADER.size)
+        (length,) = Protocol.FRAME_HEADER.unpack_from(header)
+        return Protocol.recv_exact(sock, length)
+
+    # 文件传输连接的收发缓冲区大小，足以填满高带宽或高延迟链路
+    TCP_BUFFER_SIZE = 4 * 1024 * 1024
+
+    @staticmethod
+    def set_transfer_buffers(sock: socket.socket) -> None:
+        """调大文件传输socket的收发缓冲区
+
+        需在listen/connect之前调用，握手时才能按新的缓冲区大小协商窗口扩大因子；
+        超过内核上限时由内核自动截断，设置失败时保持默认值
+        """
+        for option in (socket.SO_RCVBUF, socket.SO_SNDBUF):
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, option, Protocol.TCP_BUFFER_SIZE)
+            except OSError:
+                pass
+
+    @staticmethod
+    def set_tcp_nodelay(sock: socket.socket) -> None:
+        """关闭Nagle算法，控制消息立即发出，不等待对方的延迟确认"""
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except OSError:
+            pass
+
+    @staticmethod
+    def recv_exact(sock: socket.socket, size: int) -> bytearray:
+        """从TCP socket读取恰好size字节，连接提前关闭时抛出ConnectionError
+
+        数据通过recv_into直接写入预分配的缓冲区，返回该缓冲区本身，不再拷贝
+        """
+        buf = bytearray(size)
+        view = memoryview(buf)
+        received = 0
+        while received < size:
+            n = sock.recv_into(view[received:])
+            if not n:
+                raise ConnectionError("连接已关闭，数据接收不完整")
+            received += n
+        return buf
+
+    # 计算文件MD5时每次读取的字节数
+    HASH_CHUNK_SIZE = max(BLOCK_SIZE, 1 << 20)
+
     @staticmethod
     def calculate_file_md5(file_path: str) -> str:
         """计算文件MD5值"""
-        hash_md5 = hashlib.md5()
+        return Protocol.calculate_file_hash(file_path, Protocol.HASH_MD5)
+
+    @staticmethod
+    def calculate_file_hash(file_path: str, hash_alg: str = HASH_MD5) -> str:
+        """按指定算法计算文件摘要，返回十六进制字符串，失败时返回空字符串
+
+        优先把文件映射到内存，按HASH_CHUNK_SIZE把页缓存切片直接交给哈希对象，
+        不再经过用户空间缓冲区拷贝；无法映射时（如空文件、特殊文件）退回
+        hashlib.file_digest（Python 3.11+）或按块readinto
+        """
         try:
+            new_hasher = Protocol._hasher_factory(hash_alg)
             with open(file_path, "rb") as f:
-                for chunk in iter(lambda: f.read(4096), b""):
-                    hash_md5.update(chunk)
-            return hash_md5.hexdigest()
+                digest = Protocol._hash_mmap(f, new_hasher)
+                if digest is not None:
+                    return digest
+
+                if hasattr(hashlib, "file_digest"):
+                    return hashlib.file_digest(f, new_hasher).hexdigest()
+
+                hasher = new_hasher()
+                buffer = bytearray(Protocol.HASH_CHUNK_SIZE)
+                view = memoryview(buffer)
+                while True:
+                    n = f.readinto(buffer)
+                    if not n:
+                        break
+                    hasher.update(view[:n])
+                return hasher.hexdigest()
+        except Exception as e:
+            print(f"[错误] 计算文件{hash_alg.upper()}失败: {e}")
+            return ""
+
+    @staticmethod
+    def _hasher_factory(hash_alg: str):
+        """返回创建指定算法哈希对象的函数，算法不受支持时抛出ValueError"""
+        if hash_alg not in Protocol.SUPPORTED_HASH_ALGS:
+            raise ValueError(f"不支持的校验算法: {hash_alg}")
+        if hash_alg == Protocol.HASH_BLAKE3:
+            # 大文件由blake3内部的线程池并行计算
+            return lambda: blake3.blake3(max_threads=blake3.blake3.AUTO)
+        if hash_alg == Protocol.HASH_MD5X8:
+            return _MD5X8
+        return hashlib.md5
+
+    @staticmethod
+    def _hash_mmap(f, new_hasher) -> Optional[str]:
+        """通过内存映射计算已打开文件的摘要，无法映射时返回None"""
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return None
+        try:
+            mm = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+
+        with mm:
+            if hasattr(mm, "madvise"):
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+            with memoryview(mm) as view:
+                return Protocol._hash_view(view, new_hasher)
+
+    @staticmethod
+    def _hash_view(view: memoryview, new_hasher) -> str:
+        """按HASH_CHUNK_SIZE切片计算内存数据的摘要"""
+        hasher = new_hasher()
+        if isinstance(hasher, _MD5X8):
+            hasher.update_parallel(view)
+        else:
+            step = Protocol.HASH_CHUNK_SIZE
+            for offset in range(0, len(view), step):
+                hasher.update(view[offset:offset + step])
+        return hasher.hexdigest()
+
+    @staticmethod
+    def calculate_buffer_hash(data: Union[bytes, bytearray, memoryview, mmap.mmap],
+                              hash_alg: str = HASH_MD5) -> str:
+        """按指定算法计算内存中数据（如接收文件的内存映射）的摘要，失败时返回空字符串"""
+        try:
+            with memoryview(data) as view:
+                return Protocol._hash_view(view, Protocol._hasher_factory(hash_alg))
         except Exception as e:
-            print(f"[错误] 计算文件MD5失败: {e}")
+            print(f"[错误] 计算{hash_alg.upper()}失败: {e}")
             return ""
 
+    # 文件大小单位及对应的字节数，下标为 (位长度-1)//10
+    _SIZE_UNITS = (("B", 1), ("KB", 1 << 10), ("MB", 1 << 20), ("GB", 1 << 30))
+
     @staticmethod
     def format_file_size(size_bytes: int) -> str:
-        """格式化文件大小显示"""
+        """格式化文件大小显示
+
+        由整数位长度直接算出单位下标，只做一次除法
+        """
         if size_bytes == 0:
             return "0B"
-        size_names = ["B", "KB", "MB", "GB"]
-        i = 0
-        while size_bytes >= 1024 and i < len(size_names) - 1:
-            size_bytes /= 1024.0
-            i += 1
-        return f"{size_bytes:.1f}{size_names[i]}"
+        units = Protocol._SIZE_UNITS
+        index = min(max(int(size_bytes).bit_length() - 1, 0) // 10, len(units) - 1)
+        unit, scale = units[index]
+        return f"{size_bytes / scale:.1f}{unit}"
 
     @staticmethod
     def validate_message(message: Dict[str, Any], expected_type: str) -> bool:
@@ -5,20 +5,128 @@
 """
 
 import os
+import mmap
+import errno
 import socket
 import threading
 import time
 import sys
 import queue
+from concurrent.futures import Future
 from typing import Optional, Callable
 
 from protocol import Protocol, MessageType
 
-# 全局输入锁，确保同时只有一个线程可以使用input()
-input_lock = threading.Lock()
+# 接收文件数据的缓冲区大小；每次recv_into尽量取走socket中积压的全部数据，
+# 减少大文件接收时的系统调用和文件写入次数
+_RECV_BUFFER_SIZE = 1024 * 1024
 
-# 全局文件请求队列，用于在主线程中处理用户交互
-file_request_queue = queue.Queue()
+# 每接收64个数据块（4MB）刷新一次进度显示
+_PROGRESS_STEP = 64 * Protocol.BLOCK_SIZE
+
+# 接收文件的打开方式：原始文件描述符，不经过Python的缓冲写入层；
+# 内存映射需要可读写的描述符
+_OUTPUT_FLAGS = os.O_RDWR | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0)
+
+
+def _preallocate(fd: int, size: int) -> bool:
+    """按文件大小一次性预分配磁盘空间，返回空间是否已实际分配
+
+    平台或文件系统不支持时返回False，此时文件只能按普通方式写入：
+    写入未分配空间的内存映射在磁盘写满时会触发SIGBUS终止进程
+    """
+    if size <= 0 or not hasattr(os, 'posix_fallocate'):
+        return False
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except OSError as e:
+        # 磁盘空间不足需要报告，其余错误（如文件系统不支持）忽略
+        if e.errno == errno.ENOSPC:
+            raise
+        return False
+    return True
+
+
+def _map_output(fd: int, size: int) -> Optional[mmap.mmap]:
+    """将输出文件扩展到size字节并映射到内存，空文件或无法映射时返回None
+
+    调用前需已由_preallocate分配好磁盘空间
+    """
+    if size <= 0:
+        return None
+    try:
+        os.ftruncate(fd, size)
+        return mmap.mmap(fd, size, access=mmap.ACCESS_WRITE)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_all(fd: int, data: memoryview):
+    """将data全部写入文件描述符，处理部分写入"""
+    while data:
+        written = os.write(fd, data)
+        data = data[written:]
+
+
+def _release_mapping(view: Optional[memoryview], mapped: Optional[mmap.mmap]):
+    """释放接收缓冲区视图并关闭输出文件的内存映射"""
+    if view is not None:
+        view.release()
+    if mapped is not None:
+        mapped.close()
+
+
+class PromptBroker:
+    """标准输入代理
+
+    由唯一的读取线程持有stdin，其他线程通过ask()排队提问并等待回答，
+    提示按提交顺序逐个显示，不会打断正在进行的输入
+    """
+
+    def __init__(self):
+        self._requests = queue.SimpleQueue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    def ask(self, prompt: str = "") -> str:
+        """显示提示并返回用户输入的一行，stdin关闭时抛出EOFError"""
+        self._ensure_started()
+        reply = Future()
+        self._requests.put((prompt, reply))
+        return reply.result()
+
+    def _ensure_started(self):
+        """首次提问时启动读取线程"""
+        if self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._reader_loop, daemon=True)
+                self._thread.start()
+
+    def _reader_loop(self):
+        """逐个处理提问请求"""
+        while True:
+            prompt, reply = self._requests.get()
+            try:
+                reply.set_result(input(prompt))
+            except BaseException as e:  # EOFError等交给提问方处理
+                reply.set_exception(e)
+
+
+# 全局标准输入代理，所有需要用户输入的地方都通过它读取
+prompt_broker = PromptBroker()
+
+# 全局文件请求队列，用于在主线程中处理用户交互；
+# 只有监听线程入队、主线程出队，SimpleQueue无需Queue的条件变量
+file_request_queue = queue.SimpleQueue()
+
+# 等待用户处理的文件请求上限，超出后新请求自动拒绝
+_MAX_PENDING = 64
+
+# 有新文件请求入队时置位，主线程据此判断是否需要取队列
+file_request_event = threading.Event()
 
 
 class FileReceiver:
@@ -30,6 +138,9 @@ class FileReceiver:
         self.receive_sessions = {}  # 接收会话管理
         self.download_dir = "./downloads"  # 下载目录
 
+        # 发送确认/拒绝消息共用的UDP socket，不再每条消息创建一个
+        self._udp_out = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
         # 确保下载目录存在
         os.makedirs(self.download_dir, exist_ok=True)
 
@@ -42,11 +153,19 @@ class FileReceiver:
             file_name = message.get("file_name")
             file_size = message.get("file_size")
             file_md5 = message.get("file_md5")
+            hash_algs = message.get("hash_algs")
 
-            if not all([sender_ip, sender_port, file_name, file_size, file_md5]):
+            # file_md5可以为空，此时以TRANSFER_COMPLETE中携带的MD5为准
+            if not all([sender_ip, sender_port, file_name, file_size]):
                 print("[错误] 文件请求信息不完整")
                 return False
 
+            # 待处理请求过多时直接拒绝，避免队列无限增长
+            if file_request_queue.qsize() >= _MAX_PENDING:
+                print(f"[警告] 待处理的文件请求过多，已自动拒绝来自 {sender_ip} 的请求")
+                self._reject_file_transfer(sender_ip, sender_port)
+                return False
+
             # 将文件请求放入队列，由主线程处理用户交互
             request_data = {
                 'sender_ip': sender_ip,
@@ -54,6 +173,7 @@ class FileReceiver:
                 'file_name': file_name,
                 'file_size': file_size,
                 'file_md5': file_md5,
+                'hash_alg': Protocol.choose_hash_alg(hash_algs),
                 'response_port': sender_port,
                 'callback': callback,
                 'receiver': self  # 传递接收器实例
@@ -61,6 +181,7 @@ class FileReceiver:
 
             # 放入队列并通知主线程
             file_request_queue.put(request_data)
+            file_request_event.set()
 
             # 显示通知（不等待用户输入）
             print(f"\n[通知] 收到来自 {sender_ip}:{sender_port} 的文件传输请求")
@@ -74,12 +195,15 @@ class FileReceiver:
 
     def _accept_file_transfer(self, sender_ip: str, sender_port: int, file_name: str,
                               file_size: int, file_md5: str, response_port: int,
-                              callback: Optional[Callable]) -> bool:
-        """接受文件传输"""
+                              callback: Optional[Callable],
+                              hash_alg: str = Protocol.HASH_MD5) -> bool:
+        """接受文件传输，hash_alg为与发送方协商出的校验算法"""
         try:
             # 创建TCP监听socket
             tcp_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             tcp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            # 已接受的连接继承监听socket的缓冲区设置
+            Protocol.set_transfer_buffers(tcp_sock)
             tcp_sock.bind((self.local_ip, 0))  # 动态分配端口
             tcp_port = tcp_sock.getsockname()[1]
             tcp_sock.listen(1)
@@ -87,10 +211,9 @@ class FileReceiver:
             print(f"[信息] 已接受，开始接收...")
 
             # 发送确认消息
-            confirm_message = Protocol.create_receive_response(True, tcp_port)
-            response_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            response_sock.sendto(confirm_message, (sender_ip, response_port))
-            response_sock.close()
+            confirm_message = Protocol.create_receive_response(
+                True, tcp_port, hash_alg)
+            self._udp_out.sendto(confirm_message, (sender_ip, response_port))
 
             # 启动接收线程
             receive_thread = threading.Thread(
@@ -110,9 +233,7 @@ class FileReceiver:
         """拒绝文件传输"""
         try:
             reject_message = Protocol.create_receive_response(False)
-            response_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            response_sock.sendto(reject_message, (sender_ip, response_port))
-            response_sock.close()
+            self._udp_out.sendto(reject_message, (sender_ip, response_port))
 
             print("[信息] 已拒绝文件传输请求")
             return True
@@ -127,12 +248,15 @@ class FileReceiver:
         """接收文件数据"""
         client_sock = None
         file_path = None
+        mapped = None
+        view = None
 
         try:
             # 等待连接
             tcp_sock.settimeout(30.0)
             client_sock, addr = tcp_sock.accept()
             client_sock.settimeout(10.0)
+            Protocol.set_tcp_nodelay(client_sock)
 
             print(f"[信息] 开始接收来自 {addr[0]} 的文件...")
 
@@ -147,74 +271,97 @@ class FileReceiver:
                 counter += 1
 
             # 接收文件元信息
-            meta_length = int.from_bytes(client_sock.recv(4), byteorder='big')
-            meta_data = client_sock.recv(meta_length)
+            # 先检查消息类型，类型不符时不做JSON解析
+            meta_data = Protocol.recv_frame(client_sock)
+            if Protocol.peek_type(meta_data) != MessageType.FILE_META:
+                raise Exception("文件元信息无效")
             meta_message = Protocol.parse_message(meta_data)
-
-            if not meta_message or meta_message.get("type") != MessageType.FILE_META:
+            if not meta_message:
                 raise Exception("文件元信息无效")
 
-            total_blocks = meta_message.get("total_blocks", 0)
-            print(f"[信息] 文件将分为 {total_blocks} 块接收")
+            file_size = meta_message.get("file_size")
+            if not isinstance(file_size, int) or file_size < 0:
+                raise Exception("文件元信息缺少文件大小")
+            print(f"[信息] 文件大小: {Protocol.format_file_size(file_size)}")
 
-            # 接收文件数据
+            # 接收文件数据：元信息之后是file_size字节的原始字节流。
+            # 优先把输出文件映射到内存，recv_into直接写入文件页，不再经过
+            # 用户空间缓冲区和write；无法映射时读入预分配的缓冲区再写入文件
             bytes_received = 0
-            with open(file_path, 'wb') as f:
-                block_count = 0
-
-                while block_count < total_blocks:
-                    # 接收数据块长度
-                    length_data = client_sock.recv(4)
-                    if len(length_data) < 4:
-                        break
-
-                    block_length = int.from_bytes(length_data, byteorder='big')
-
-                    # 接收数据块
-                    block_data = b""
-                    while len(block_data) < block_length:
-                        chunk = client_sock.recv(
-                            min(block_length - len(block_data), 8192))
-                        if not chunk:
-                            break
-                        block_data += chunk
-
-                    if len(block_data) != block_length:
-                        raise Exception("数据块接收不完整")
+            next_report = 0
+            fd = os.open(file_path, _OUTPUT_FLAGS, 0o644)
+            try:
+                # 只有磁盘空间已预先分配时才映射，否则磁盘写满不会报告为OSError
+                mapped = None
+                if _preallocate(fd, file_size):
+                    mapped = _map_output(fd, file_size)
+                if mapped is not None:
+                    view = memoryview(mapped)
+                else:
+                    view = memoryview(bytearray(_RECV_BUFFER_SIZE))
+                while bytes_received < file_size:
+                    remaining = file_size - bytes_received
+                    if mapped is not None:
+                        n = client_sock.recv_into(view[bytes_received:], remaining)
+                    else:
+                        n = client_sock.recv_into(view, min(len(view), remaining))
+                    if not n:
+                        raise Exception("连接中断，文件接收不完整")
 
                     # 写入文件
-                    f.write(block_data)
-                    bytes_received += len(block_data)
-                    block_count += 1
-
-                    # 显示进度
-                    progress = (bytes_received / expected_size) * 100
-                    print(
-                        f"\r[接收] 进度: {progress:.1f}% ({Protocol.format_file_size(bytes_received)}/{Protocol.format_file_size(expected_size)})", end='', flush=True)
+                    if mapped is None:
+                        _write_all(fd, view[:n])
+                    bytes_received += n
+
+                    # 每收到_PROGRESS_STEP字节显示一次进度，避免每次接收都格式化输出
+                    if bytes_received >= next_report or bytes_received == file_size:
+                        next_report = bytes_received + _PROGRESS_STEP
+                        progress = (bytes_received / file_size) * 100
+                        print(
+                            f"\r[接收] 进度: {progress:.1f}% ({Protocol.format_file_size(bytes_received)}/{Protocol.format_file_size(file_size)})", end='', flush=True)
+            finally:
+                # 映射在描述符关闭后仍然有效
+                os.close(fd)
 
             print()  # 换行
 
             # 接收传输完成消息
-            complete_length = int.from_bytes(
-                client_sock.recv(4), byteorder='big')
-            complete_data = client_sock.recv(complete_length)
+            complete_data = Protocol.recv_frame(client_sock)
+            if Protocol.peek_type(complete_data) != MessageType.TRANSFER_COMPLETE:
+                raise Exception("传输完成消息无效")
             complete_message = Protocol.parse_message(complete_data)
-
-            if not complete_message or complete_message.get("type") != MessageType.TRANSFER_COMPLETE:
+            if not complete_message:
                 raise Exception("传输完成消息无效")
 
+            # 发送方边发送边计算摘要，以传输完成消息中的算法和值为准；
+            # 旧版本发送方不携带算法字段，只发送MD5
+            hash_alg = complete_message.get("hash_alg") or Protocol.HASH_MD5
+            if hash_alg == Protocol.HASH_MD5:
+                expected_hash = complete_message.get("file_md5") or expected_md5
+            else:
+                expected_hash = complete_message.get("file_hash")
+            if not expected_hash:
+                raise Exception(f"传输完成消息缺少{hash_alg.upper()}")
+            if hash_alg not in Protocol.SUPPORTED_HASH_ALGS:
+                raise Exception(f"不支持的校验算法: {hash_alg}")
+
             # 校验文件完整性
             print("[信息] 正在校验文件完整性...")
-            received_md5 = Protocol.calculate_file_md5(file_path)
+            if mapped is not None:
+                # 直接对接收时的内存映射计算，不再重新读取文件
+                received_hash = Protocol.calculate_buffer_hash(view, hash_alg)
+            else:
+                received_hash = Protocol.calculate_file_hash(file_path, hash_alg)
+            _release_mapping(view, mapped)
+            view = mapped = None
 
-            if received_md5 == expected_md5:
-                print("[完成] 文件接收成功，MD5校验一致")
+            if received_hash == expected_hash:
+                print(f"[完成] 文件接收成功，{hash_alg.upper()}校验一致")
                 print(f"[信息] 文件已保存到: {file_path}")
 
                 # 发送ACK确认
                 ack_message = Protocol.create_ack(0)
-                client_sock.send(len(ack_message).to_bytes(4, byteorder='big'))
-                client_sock.send(ack_message)
+                Protocol.send_frame(client_sock, ack_message)
 
                 if callback:
                     callback(True, f"文件已保存到: {file_path}")
@@ -223,7 +370,7 @@ class FileReceiver:
                 print("\nP2P> ", end='', flush=True)
 
             else:
-                print("[错误] 文件校验失败，MD5不匹配")
+                print(f"[错误] 文件校验失败，{hash_alg.upper()}不匹配")
                 # 删除损坏的文件
                 try:
                     os.remove(file_path)
@@ -231,10 +378,9 @@ class FileReceiver:
                     pass
 
                 # 发送错误消息
-                error_message = Protocol.create_error("MD5校验失败")
-                client_sock.send(
-                    len(error_message).to_bytes(4, byteorder='big'))
-                client_sock.send(error_message)
+                error_message = Protocol.create_error(
+                    f"{hash_alg.upper()}校验失败")
+                Protocol.send_frame(client_sock, error_message)
 
                 if callback:
                     callback(False, "文件校验失败")
@@ -244,6 +390,8 @@ class FileReceiver:
 
         except Exception as e:
             print(f"\n[错误] 文件接收失败: {e}")
+            _release_mapping(view, mapped)
+            view = mapped = None
 
             # 清理损坏的文件
             if file_path and os.path.exists(file_path):
@@ -260,6 +408,7 @@ class FileReceiver:
 
         finally:
             # 清理资源
+            _release_mapping(view, mapped)
             if client_sock:
                 try:
                     client_sock.close()
@@ -279,6 +428,13 @@ class FileReceiver:
         self.download_dir = directory
         os.makedirs(self.download_dir, exist_ok=True)
 
+    def close(self):
+        """关闭发送响应消息的UDP socket"""
+        try:
+            self._udp_out.close()
+        except OSError:
+            pass
+
 
 def process_file_request(request_data):
     """在主线程中处理文件请求"""
@@ -288,6 +444,7 @@ def process_file_request(request_data):
     file_name = request_data['file_name']
     file_size = request_data['file_size']
     file_md5 = request_data['file_md5']
+    hash_alg = request_data.get('hash_alg', Protocol.HASH_MD5)
     response_port = request_data['response_port']
     callback = request_data['callback']
 
@@ -298,21 +455,20 @@ def process_file_request(request_data):
     print(f"文件: {file_name} ({Protocol.format_file_size(file_size)})")
     print("="*50)
 
-    # 用户确认 - 在主线程中处理，不需要锁
+    # 用户确认 - 通过输入代理读取
     try:
-        print("是否接受？(y/n): ", end='', flush=True)
-        response = input().strip().lower()
+        response = prompt_broker.ask("是否接受？(y/n): ").strip().lower()
 
         # 处理无效输入
         while response not in ['y', 'yes', '是', 'n', 'no', '否']:
             print("[提示] 请输入 y(是) 或 n(否)")
-            print("是否接受？(y/n): ", end='', flush=True)
-            response = input().strip().lower()
+            response = prompt_broker.ask("是否接受？(y/n): ").strip().lower()
 
         if response in ['y', 'yes', '是']:
             # 接受文件
             return receiver._accept_file_transfer(sender_ip, sender_port, file_name,
-                                                  file_size, file_md5, response_port, callback)
+                                                  file_size, file_md5, response_port, callback,
+                                                  hash_alg)
         else:
             # 拒绝文件
             result = receiver._reject_file_transfer(sender_ip, response_port)
@@ -5,6 +5,9 @@
 """
 
 import os
+import heapq
+import itertools
+import select
 import socket
 import threading
 import time
@@ -12,68 +15,115 @@ from typing import Optional, Callable
 
 from protocol import Protocol, MessageType
 
+# 每次sendfile调用发送的最大字节数，也是进度显示的间隔
+_SENDFILE_WINDOW = 4 * 1024 * 1024
+
+# 等待对方确认的超时时间（秒）
+_RESPONSE_TIMEOUT = 30.0
+
+
+def _sendfile(sock: socket.socket, f, offset: int, count: int) -> int:
+    """调用os.sendfile发送文件中从offset开始的最多count字节，返回实际发送的字节数
+
+    带超时的socket是非阻塞的，发送缓冲区已满时等待其可写，超过socket的
+    超时时间抛出socket.timeout；没有os.sendfile的平台交给socket.sendfile
+    """
+    if not hasattr(os, 'sendfile'):
+        return sock.sendfile(f, offset, count)
+    while True:
+        try:
+            return os.sendfile(sock.fileno(), f.fileno(), offset, count)
+        except BlockingIOError:
+            _, writable, _ = select.select((), (sock,), (), sock.gettimeout())
+            if not writable:
+                raise socket.timeout("发送文件数据超时")
+
+
+class TransferCtx:
+    """待发送文件的信息
+
+    推送请求时获取一次，保存在响应处理器中，开始传输时直接使用，
+    不再重复stat文件和计算文件名、块数
+    """
+
+    __slots__ = ('path', 'name', 'size', 'total_blocks')
+
+    def __init__(self, path: str, name: str, size: int, total_blocks: int):
+        self.path = path
+        self.name = name
+        self.size = size
+        self.total_blocks = total_blocks
+
+    @classmethod
+    def from_path(cls, path: str) -> 'TransferCtx':
+        """读取文件信息创建，文件不存在时抛出FileNotFoundError"""
+        size = os.stat(path).st_size
+        total_blocks = (size + Protocol.BLOCK_SIZE - 1) // Protocol.BLOCK_SIZE
+        return cls(path, os.path.basename(path), size, total_blocks)
+
 
 class FileSender:
     """文件发送类"""
 
-    def __init__(self, local_ip: str, local_port: int):
+    def __init__(self, local_ip: str, local_port: int,
+                 udp_socket: Optional[socket.socket] = None):
         self.local_ip = local_ip
         self.local_port = local_port
         self.transfer_sessions = {}  # 传输会话管理
         self.response_handlers = {}  # 响应处理器
 
+        # 发送推送请求的UDP socket：优先使用节点绑定在local_port上的业务socket，
+        # 请求从业务端口发出，对方的响应也回到同一端口；未提供时自行创建一个
+        self._owns_udp = udp_socket is None
+        self._udp_out = udp_socket if udp_socket is not None else socket.socket(
+            socket.AF_INET, socket.SOCK_DGRAM)
+
+        # 响应超时的截止时间最小堆 [(截止时间, 序号, 响应键, 处理器), ...]，
+        # 由一个超时线程统一等待，不再为每个请求启动一个休眠线程
+        self._deadlines = []
+        self._deadline_seq = itertools.count()
+        self._deadline_cond = threading.Condition()
+        self._timeout_thread = None
+
     def send_file_offer(self, target_ip: str, target_port: int, file_path: str,
                         broadcast_port: int, callback: Optional[Callable] = None) -> bool:
         """发送文件推送请求"""
 
-        # 检查文件是否存在
-        if not os.path.exists(file_path):
+        # 获取文件信息；文件摘要在传输过程中计算，随TRANSFER_COMPLETE发送
+        try:
+            ctx = TransferCtx.from_path(file_path)
+        except FileNotFoundError:
             print(f"[错误] 文件不存在: {file_path}")
             return False
-
-        # 获取文件信息
-        try:
-            file_size = os.path.getsize(file_path)
-            file_md5 = Protocol.calculate_file_md5(file_path)
-            if not file_md5:
-                return False
-
-            print(
-                f"[信息] 正在向 {target_ip}:{target_port} 推送文件 {os.path.basename(file_path)} ({Protocol.format_file_size(file_size)})")
-
         except Exception as e:
             print(f"[错误] 读取文件信息失败: {e}")
             return False
 
+        print(
+            f"[信息] 正在向 {target_ip}:{target_port} 推送文件 {ctx.name} ({Protocol.format_file_size(ctx.size)})")
+
         # 创建发送请求消息
         offer_message = Protocol.create_send_offer(
-            self.local_ip, self.local_port, file_path, file_size, file_md5
+            self.local_ip, self.local_port, ctx.name, ctx.size, ""
         )
 
         # 发送UDP请求到目标节点的业务端口
         try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            sock.sendto(offer_message, (target_ip, target_port))
-            sock.close()
+            self._udp_out.sendto(offer_message, (target_ip, target_port))
 
             print("[等待] 等待对方确认...")
 
             # 注册响应处理器
             response_key = f"{target_ip}:{target_port}"
-            self.response_handlers[response_key] = {
-                'file_path': file_path,
-                'file_md5': file_md5,
+            handler = {
+                'ctx': ctx,
                 'callback': callback,
                 'timestamp': time.time()
             }
+            self.response_handlers[response_key] = handler
 
-            # 启动超时检查线程
-            timeout_thread = threading.Thread(
-                target=self._check_timeout,
-                args=(response_key, 30.0)
-            )
-            timeout_thread.daemon = True
-            timeout_thread.start()
+            # 登记超时检查
+            self._schedule_timeout(response_key, handler, _RESPONSE_TIMEOUT)
 
             return True
 
@@ -103,12 +153,20 @@ class FileSender:
             if message.get("type") == MessageType.RECEIVE_CONFIRM:
                 print("[成功] 对方已接受，开始传输...")
                 tcp_port = message.get("tcp_port")
+                # 旧版本接收方不回复校验算法，或回复了本机不支持的算法时使用MD5
+                hash_alg = message.get("hash_alg")
+                if hash_alg not in Protocol.SUPPORTED_HASH_ALGS:
+                    hash_alg = Protocol.HASH_MD5
                 if tcp_port:
-                    # 开始文件传输
+                    # 在独立线程中传输文件：响应由监听器的反应器线程分发，
+                    # 传输期间不能阻塞广播接收和其他业务报文的处理
                     target_ip, target_port = sender_key.split(":")
-                    self._start_file_transfer(
-                        handler['file_path'], handler['file_md5'],
-                        target_ip, tcp_port, handler['callback'])
+                    send_thread = threading.Thread(
+                        target=self._start_file_transfer,
+                        args=(handler['ctx'], target_ip, tcp_port,
+                              handler['callback'], hash_alg),
+                        daemon=True)
+                    send_thread.start()
                 # 移除响应处理器
                 del self.response_handlers[sender_key]
 
@@ -122,79 +180,116 @@ class FileSender:
         except Exception as e:
             print(f"[错误] 处理响应失败: {e}")
 
-    def _check_timeout(self, response_key: str, timeout: float):
-        """检查响应超时"""
-        time.sleep(timeout)
+    def _schedule_timeout(self, response_key: str, handler: dict, timeout: float):
+        """登记响应超时，首次调用时启动超时线程"""
+        with self._deadline_cond:
+            heapq.heappush(self._deadlines, (time.monotonic() + timeout,
+                                             next(self._deadline_seq),
+                                             response_key, handler))
+            if self._timeout_thread is None:
+                self._timeout_thread = threading.Thread(
+                    target=self._timeout_loop, daemon=True)
+                self._timeout_thread.start()
+            self._deadline_cond.notify()
+
+    def _timeout_loop(self):
+        """等待最近的截止时间，处理超时仍未收到响应的请求"""
+        while True:
+            with self._deadline_cond:
+                while not self._deadlines:
+                    self._deadline_cond.wait()
+                wait_time = self._deadlines[0][0] - time.monotonic()
+                if wait_time > 0:
+                    self._deadline_cond.wait(wait_time)
+                    continue
+                _, _, response_key, handler = heapq.heappop(self._deadlines)
+
+            # 已收到响应或被新的请求替换时跳过
+            if self.response_handlers.get(response_key) is not handler:
+                continue
+            self.response_handlers.pop(response_key, None)
 
-        handler = self.response_handlers.get(response_key)
-        if handler:
             print("[超时] 等待响应超时")
             if handler['callback']:
                 handler['callback'](False, "响应超时")
-            # 移除超时的响应处理器
-            if response_key in self.response_handlers:
-                del self.response_handlers[response_key]
 
-    def _start_file_transfer(self, file_path: str, file_md5: str, target_ip: str,
-                             target_port: int, callback: Optional[Callable]):
-        """开始文件传输"""
+    def _start_file_transfer(self, ctx: TransferCtx, target_ip: str,
+                             target_port: int, callback: Optional[Callable],
+                             hash_alg: str = Protocol.HASH_MD5):
+        """开始文件传输
+
+        发送的同时在后台线程中按hash_alg计算文件摘要，发送完成后随
+        TRANSFER_COMPLETE发出，发送方不再在发送前单独读一遍文件
+        """
+        hash_result = []
+        hash_thread = threading.Thread(
+            target=lambda: hash_result.append(
+                Protocol.calculate_file_hash(ctx.path, hash_alg)),
+            daemon=True)
+        hash_thread.start()
+
         try:
             # 建立TCP连接
             tcp_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             tcp_sock.settimeout(10.0)
+            Protocol.set_transfer_buffers(tcp_sock)
             tcp_sock.connect((target_ip, target_port))
+            Protocol.set_tcp_nodelay(tcp_sock)
 
-            # 发送文件元信息
-            file_size = os.path.getsize(file_path)
-            total_blocks = (file_size + Protocol.BLOCK_SIZE -
-                            1) // Protocol.BLOCK_SIZE
+            # Linux上在元信息、文件数据和完成消息发送期间塞住连接，
+            # 让小的控制消息与文件数据合并成满长度的报文段
+            cork = getattr(socket, 'TCP_CORK', None)
+            if cork is not None:
+                tcp_sock.setsockopt(socket.IPPROTO_TCP, cork, 1)
 
+            # 发送文件元信息
+            file_size = ctx.size
             meta_message = Protocol.create_file_meta(
-                os.path.basename(file_path), total_blocks)
-            tcp_sock.send(len(meta_message).to_bytes(4, byteorder='big'))
-            tcp_sock.send(meta_message)
+                ctx.name, ctx.total_blocks, file_size)
+            Protocol.send_frame(tcp_sock, meta_message)
 
-            # 发送文件数据
-            with open(file_path, 'rb') as f:
-                block_number = 0
+            # 发送文件数据：元信息之后直接是原始字节流，
+            # 由sendfile在内核中从文件拷贝到socket，不经过用户空间
+            with open(ctx.path, 'rb') as f:
                 bytes_sent = 0
-
-                while True:
-                    block_data = f.read(Protocol.BLOCK_SIZE)
-                    if not block_data:
-                        break
-
-                    # 发送数据块长度和数据
-                    tcp_sock.send(len(block_data).to_bytes(4, byteorder='big'))
-                    tcp_sock.send(block_data)
-
-                    bytes_sent += len(block_data)
-                    block_number += 1
-
-                    # 显示进度
+                next_report = 0
+
+                while bytes_sent < file_size:
+                    count = min(_SENDFILE_WINDOW, file_size - bytes_sent)
+                    sent = _sendfile(tcp_sock, f, bytes_sent, count)
+                    if not sent:
+                        raise Exception("文件在发送过程中被截断")
+                    bytes_sent += sent
+
+                    # 每发送_SENDFILE_WINDOW字节显示一次进度
+                    if bytes_sent < next_report and bytes_sent < file_size:
+                        continue
+                    next_report = bytes_sent + _SENDFILE_WINDOW
                     progress = (bytes_sent / file_size) * 100
                     print(
                         f"\r[传输] 进度: {progress:.1f}% ({Protocol.format_file_size(bytes_sent)}/{Protocol.format_file_size(file_size)})", end='', flush=True)
 
-                    # 等待ACK（可选，简化版本先不等待）
-                    time.sleep(0.001)  # 小延迟避免发送过快
-
             print()  # 换行
 
-            # 发送传输完成消息
-            complete_message = Protocol.create_transfer_complete(file_md5)
-            tcp_sock.send(len(complete_message).to_bytes(4, byteorder='big'))
-            tcp_sock.send(complete_message)
+            # 等待摘要计算完成后发送传输完成消息
+            hash_thread.join()
+            file_hash = hash_result[0] if hash_result else ""
+            if not file_hash:
+                raise Exception(f"计算文件{hash_alg.upper()}失败")
+            complete_message = Protocol.create_transfer_complete(
+                file_hash, hash_alg)
+            Protocol.send_frame(tcp_sock, complete_message)
+            if cork is not None:
+                # 取消塞住，立即发出剩余数据
+                tcp_sock.setsockopt(socket.IPPROTO_TCP, cork, 0)
 
             print("[完成] 文件已发送，等待校验...")
 
-            # 等待最终确认
-            response_length = int.from_bytes(tcp_sock.recv(4), byteorder='big')
-            response_data = tcp_sock.recv(response_length)
-            response = Protocol.parse_message(response_data)
+            # 等待最终确认；确认消息用正则提取，不做JSON解析
+            response_data = Protocol.recv_frame(tcp_sock)
 
-            if response and response.get("type") == MessageType.ACK:
-                print("[完成] 文件传输成功，MD5校验一致")
+            if Protocol.parse_ack(response_data) is not None:
+                print(f"[完成] 文件传输成功，{hash_alg.upper()}校验一致")
                 if callback:
                     callback(True, "传输成功")
             else:
@@ -215,3 +310,12 @@ class FileSender:
     def get_transfer_status(self) -> dict:
         """获取传输状态"""
         return self.transfer_sessions.copy()
+
+    def close(self):
+        """关闭自行创建的UDP socket，共享的业务socket由其所有者关闭"""
+        if not self._owns_udp:
+            return
+        try:
+            self._udp_out.close()
+        except OSError:
+            pass
@@ -4,18 +4,36 @@ P2P文件传输系统单元测试
 """
 
 import unittest
+import contextlib
+import errno
+import io
 import os
-import time
+import socket
+import select
 import tempfile
-from unittest.mock import Mock
+import threading
+import time
+from unittest.mock import Mock, patch, mock_open
 
 # 导入被测试的模块
-from protocol import Protocol, MessageType
+from protocol import Protocol, MessageType, _MD5X8
 from neighbors import NeighborManager
 from listener import BroadcastListener
 from broadcast import BroadcastSender
-from send_file import FileSender
-from recv_file import FileReceiver
+from send_file import FileSender, TransferCtx, _SENDFILE_WINDOW
+from recv_file import FileReceiver, _preallocate
+from main import parse_arguments
+from utils import (generate_unique_node_name, send_datagrams, BatchReceiver, make_node_key, split_node_key,
+                   serialize_message, deserialize_message, is_port_available,
+                   find_available_port, get_timestamp, format_time)
+
+
+def offline_components():
+    """屏蔽socket和下载目录的创建，只测试组件初始化逻辑时不占用真实资源"""
+    stack = contextlib.ExitStack()
+    stack.enter_context(patch('socket.socket'))
+    stack.enter_context(patch('os.makedirs'))
+    return stack
 
 
 class TestBasicFunctionality(unittest.TestCase):
@@ -39,12 +57,14 @@ class TestBasicFunctionality(unittest.TestCase):
     def test_neighbor_manager_initialization(self):
         """测试邻居管理器初始化"""
         neighbor_manager = NeighborManager()
+        self.addCleanup(neighbor_manager.stop)
         self.assertIsNotNone(neighbor_manager)
         self.assertEqual(neighbor_manager.get_neighbor_count(), 0)
 
     def test_neighbor_manager_operations(self):
         """测试邻居管理器基本操作"""
         neighbor_manager = NeighborManager()
+        self.addCleanup(neighbor_manager.stop)
 
         # 添加邻居
         node_info = {
@@ -64,6 +84,13 @@ class TestBasicFunctionality(unittest.TestCase):
         neighbors = neighbor_manager.get_all_neighbors()
         self.assertEqual(len(neighbors), 1)
 
+        # 显示用快照及格式化
+        rows = neighbor_manager.snapshot_rows()
+        self.assertEqual(rows[0][:3], ('test_node', '192.168.1.100', 12000))
+        # 单调时钟纳秒换算回系统时间（秒）
+        self.assertAlmostEqual(rows[0][3], time.time(), delta=5)
+        self.assertIn('test_node', neighbor_manager.format_neighbors_list())
+
     def test_broadcast_listener_initialization(self):
         """测试广播监听器初始化"""
         neighbor_manager = Mock()
@@ -83,6 +110,68 @@ class TestBasicFunctionality(unittest.TestCase):
         self.assertEqual(listener.broadcast_port, 23333)
         self.assertFalse(listener.running)
 
+    def test_broadcast_listener_deduplication(self):
+        """测试重复广播报文去重"""
+        neighbor_manager = Mock()
+        neighbor_manager.get_neighbor.return_value = None
+        listener = BroadcastListener(neighbor_manager, "192.168.1.100", 12000)
+
+        frame = bytes(Protocol.create_discovery_frame(
+            "remote_node", "192.168.1.101", 12001))
+        listener._handle_broadcast_message(frame, ("192.168.1.101", 23333))
+        listener._handle_broadcast_message(frame, ("192.168.1.101", 23333))
+
+        self.assertEqual(neighbor_manager.add_or_update_neighbor.call_count, 1)
+
+    def test_broadcast_listener_ignores_self(self):
+        """测试过滤自身广播"""
+        neighbor_manager = Mock()
+        listener = BroadcastListener(neighbor_manager, "192.168.1.100", 12000)
+
+        own = bytes(Protocol.create_discovery_frame("me", "192.168.1.100", 12000))
+        same_host = bytes(Protocol.create_discovery_frame(
+            "other", "192.168.1.100", 12001))
+        listener._handle_broadcast_message(own, ("192.168.1.100", 23333))
+        listener._handle_broadcast_message(same_host, ("192.168.1.100", 23333))
+
+        self.assertEqual(neighbor_manager.add_or_update_neighbor.call_count, 1)
+
+    def test_business_drain_ignores_connection_reset(self):
+        """测试业务socket接收时的ConnectionResetError不会中断后续报文的处理"""
+        listener = BroadcastListener(Mock(), "192.168.1.100", 12000)
+        listener.running = True
+        payload = Protocol.create_receive_response(False)
+
+        # 依次模拟：ICMP端口不可达导致的重置、一个正常报文、已取完
+        steps = iter([ConnectionResetError(), payload, BlockingIOError()])
+
+        def fake_recv(buf):
+            step = next(steps)
+            if isinstance(step, Exception):
+                raise step
+            buf[:len(step)] = step
+            return len(step), ("192.168.1.101", 12001)
+
+        sock = Mock()
+        sock.recvfrom_into.side_effect = fake_recv
+        with patch.object(listener, '_handle_business_message') as handle:
+            listener._drain_business_socket(sock)
+        self.assertEqual(handle.call_count, 1)
+        self.assertEqual(bytes(handle.call_args[0][0]), payload)
+
+    def test_broadcast_listener_prefix_filter(self):
+        """测试广播报文前缀过滤"""
+        is_known = BroadcastListener._is_known_broadcast
+        frame = Protocol.create_discovery_frame("node", "192.168.1.101", 12001)
+
+        self.assertTrue(is_known(memoryview(frame)))
+        self.assertTrue(is_known(Protocol.create_discovery_message(
+            "node", "192.168.1.101", 12001)))
+        self.assertTrue(is_known(b'{"type":"SEND_OFFER","file_name":"a"}'))
+        self.assertFalse(is_known(b'{"type": "ACK"}'))
+        self.assertFalse(is_known(b'M-SEARCH * HTTP/1.1'))
+        self.assertFalse(is_known(b''))
+
     def test_broadcast_sender_initialization(self):
         """测试广播发送器初始化"""
         sender = BroadcastSender("192.168.1.100", 12000, 23333, "test_node")
@@ -91,46 +180,100 @@ class TestBasicFunctionality(unittest.TestCase):
         self.assertEqual(sender.local_port, 12000)
         self.assertEqual(sender.broadcast_port, 23333)
 
+    def test_broadcast_sender_targets(self):
+        """测试发现报文同时发往全局广播地址和链路本地组播组"""
+        sender = BroadcastSender("192.168.1.100", 12000, 23333, "test_node")
+        self.assertEqual(sender.refresh_broadcast_address(),
+                         [("255.255.255.255", 23333), ("224.0.0.200", 23333)])
+
     def test_file_sender_initialization(self):
         """测试文件发送器初始化"""
-        sender = FileSender("192.168.1.100", 12000)
+        with offline_components():
+            sender = FileSender("192.168.1.100", 12000)
 
         self.assertEqual(sender.local_ip, "192.168.1.100")
         self.assertEqual(sender.local_port, 12000)
 
+    def test_file_sender_response_does_not_block(self):
+        """测试收到确认后在独立线程中传输，不阻塞监听器线程"""
+        with offline_components():
+            sender = FileSender("192.168.1.100", 12000)
+        sender.response_handlers["192.168.1.101:12001"] = {
+            'ctx': TransferCtx("a.bin", "a.bin", 0, 0), 'callback': None}
+
+        started = threading.Event()
+        release = threading.Event()
+
+        def blocking_transfer(*args):
+            started.set()
+            release.wait(5)
+
+        with patch.object(sender, '_start_file_transfer', blocking_transfer):
+            sender.handle_response(
+                {"type": MessageType.RECEIVE_CONFIRM, "tcp_port": 40000},
+                ("192.168.1.101", 12001))
+            self.assertTrue(started.wait(5))
+            release.set()
+        self.assertEqual(sender.response_handlers, {})
+
     def test_file_receiver_initialization(self):
         """测试文件接收器初始化"""
-        receiver = FileReceiver("192.168.1.100", 12000)
+        with offline_components():
+            receiver = FileReceiver("192.168.1.100", 12000)
 
         self.assertEqual(receiver.local_ip, "192.168.1.100")
         self.assertEqual(receiver.local_port, 12000)
 
     def test_file_operations(self):
-        """测试基本文件操作"""
-        # 创建临时文件
-        with tempfile.NamedTemporaryFile(delete=False) as temp_file:
-            test_content = b"Hello, P2P World!"
-            temp_file.write(test_content)
-            temp_file.flush()
+        """测试待发送文件信息的获取（文件系统调用被替换，不访问磁盘）"""
+        file_size = 3 * Protocol.BLOCK_SIZE + 1
+        fake_stat = os.stat_result((0o100644, 0, 0, 1, 0, 0, file_size, 0, 0, 0))
+        with patch('os.stat', return_value=fake_stat) as stat:
+            ctx = TransferCtx.from_path("/fake/dir/test.bin")
 
-            # 检查文件存在
-            self.assertTrue(os.path.exists(temp_file.name))
-
-            # 检查文件大小
-            file_size = os.path.getsize(temp_file.name)
-            self.assertEqual(file_size, len(test_content))
-
-            # 清理
-            os.unlink(temp_file.name)
+        stat.assert_called_once_with("/fake/dir/test.bin")
+        self.assertEqual(ctx.name, "test.bin")
+        self.assertEqual(ctx.size, file_size)
+        self.assertEqual(ctx.total_blocks, 4)
 
     def test_downloads_directory(self):
-        """测试下载目录创建"""
-        downloads_dir = "./downloads"
-        if not os.path.exists(downloads_dir):
-            os.makedirs(downloads_dir)
-
-        self.assertTrue(os.path.exists(downloads_dir))
-        self.assertTrue(os.path.isdir(downloads_dir))
+        """测试下载目录创建（不访问磁盘）"""
+        with offline_components(), patch('os.makedirs') as makedirs:
+            receiver = FileReceiver("192.168.1.100", 12000)
+            receiver.set_download_directory("/fake/downloads")
+
+        self.assertEqual(receiver.download_dir, "/fake/downloads")
+        makedirs.assert_called_with("/fake/downloads", exist_ok=True)
+
+    def test_preallocate_reports_reservation(self):
+        """测试只有实际预分配了磁盘空间时才报告成功"""
+        self.assertFalse(_preallocate(-1, 0))
+        with patch('os.posix_fallocate', create=True,
+                   side_effect=OSError(errno.EOPNOTSUPP, "not supported")):
+            self.assertFalse(_preallocate(-1, 4096))
+        with patch('os.posix_fallocate', create=True,
+                   side_effect=OSError(errno.ENOSPC, "no space")):
+            with self.assertRaises(OSError):
+                _preallocate(-1, 4096)
+        with patch('os.posix_fallocate', create=True, return_value=None):
+            self.assertTrue(_preallocate(-1, 4096))
+
+    def test_protocol_frames(self):
+        """测试TCP消息帧收发"""
+        left, right = socket.socketpair()
+        try:
+            Protocol.send_frame(left, Protocol.create_ack(0))
+            Protocol.send_frame(left, b"")
+            message = Protocol.parse_message(Protocol.recv_frame(right))
+            self.assertEqual(message['type'], MessageType.ACK)
+            self.assertEqual(Protocol.recv_frame(right), b"")
+
+            left.close()
+            with self.assertRaises(ConnectionError):
+                Protocol.recv_frame(right)
+        finally:
+            left.close()
+            right.close()
 
     def test_protocol_parse_message(self):
         """测试协议消息解析"""
@@ -143,6 +286,246 @@ class TestBasicFunctionality(unittest.TestCase):
         self.assertEqual(parsed['ip'], "192.168.1.100")
         self.assertEqual(parsed['port'], 12000)
 
+        # 接收缓冲区的memoryview切片可以直接解析
+        buf = bytearray(test_data + b"garbage")
+        parsed = Protocol.parse_message(memoryview(buf)[:len(test_data)])
+        self.assertEqual(parsed['type'], "NODE_DISCOVERY")
+
+    def test_protocol_cached_messages(self):
+        """测试预生成的控制消息"""
+        ack = Protocol.parse_message(Protocol.create_ack(42))
+        self.assertEqual(ack, {'type': MessageType.ACK, 'block_number': 42})
+
+        complete = Protocol.parse_message(
+            Protocol.create_transfer_complete('0' * 32))
+        self.assertEqual(complete['type'], MessageType.TRANSFER_COMPLETE)
+        self.assertEqual(complete['file_md5'], '0' * 32)
+
+        reject = Protocol.parse_message(Protocol.create_receive_response(False))
+        self.assertEqual(reject['type'], MessageType.RECEIVE_REJECT)
+
+    def test_peek_type(self):
+        """测试不解析JSON读取消息类型"""
+        meta = Protocol.create_file_meta("a.txt", 1, 10)
+        self.assertEqual(Protocol.peek_type(meta), MessageType.FILE_META)
+        self.assertEqual(Protocol.peek_type(memoryview(bytearray(meta))),
+                         MessageType.FILE_META)
+        self.assertEqual(Protocol.peek_type(b'{"type": "ACK"}'), MessageType.ACK)
+        self.assertIsNone(Protocol.peek_type(b'{"name": "x"}'))
+
+        self.assertEqual(Protocol.parse_ack(Protocol.create_ack(7)), 7)
+        self.assertIsNone(Protocol.parse_ack(Protocol.create_error("x")))
+
+    def test_hash_alg_negotiation(self):
+        """测试校验算法协商"""
+        # 旧版本节点不携带算法列表时使用MD5
+        self.assertEqual(Protocol.choose_hash_alg(None), Protocol.HASH_MD5)
+        self.assertEqual(Protocol.choose_hash_alg(['md5']), Protocol.HASH_MD5)
+        self.assertEqual(Protocol.choose_hash_alg(list(Protocol.SUPPORTED_HASH_ALGS)),
+                         Protocol.SUPPORTED_HASH_ALGS[0])
+
+        complete = Protocol.parse_message(
+            Protocol.create_transfer_complete('ab' * 32, 'blake3'))
+        self.assertEqual(complete['hash_alg'], 'blake3')
+        self.assertEqual(complete['file_hash'], 'ab' * 32)
+
+    def test_md5x8_parallel_matches_sequential(self):
+        """测试8路并行MD5与顺序计算结果一致"""
+        data = os.urandom(_MD5X8.LANES * _MD5X8._STRIPE + 12345)
+        with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+            temp_file.write(data)
+        try:
+            sequential = _MD5X8()
+            for offset in range(0, len(data), 100000):
+                sequential.update(data[offset:offset + 100000])
+            self.assertEqual(
+                Protocol.calculate_file_hash(temp_file.name, Protocol.HASH_MD5X8),
+                sequential.hexdigest())
+        finally:
+            os.unlink(temp_file.name)
+
+    def test_md5x8_known_answer(self):
+        """测试md5x8-1m摘要的已知结果：空输入及9 MiB + 7字节（第0路有两个条带）"""
+        self.assertEqual(Protocol.calculate_buffer_hash(b'', Protocol.HASH_MD5X8),
+                         'e7dd4330655dc61ec7f53e526532adfa')
+        data = bytes(i % 251 for i in range(9 * (1 << 20) + 7))
+        self.assertEqual(Protocol.calculate_buffer_hash(data, Protocol.HASH_MD5X8),
+                         '588a839edaae4d0b78035149067104ca')
+
+    def test_local_ip_cache(self):
+        """测试本机IP缓存：失败结果不缓存，清除缓存后重新探测"""
+        import utils
+        utils.invalidate_local_ip_cache()
+        try:
+            with patch('utils._probe_local_ip', side_effect=[None, '10.0.0.5', '10.0.0.6']) as probe:
+                self.assertEqual(utils.get_local_ip(), "192.168.1.100")
+                self.assertEqual(utils.get_local_ip(), '10.0.0.5')
+                self.assertEqual(utils.get_local_ip(), '10.0.0.5')
+                self.assertEqual(probe.call_count, 2)
+
+                utils.invalidate_local_ip_cache()
+                self.assertEqual(utils.get_local_ip(), '10.0.0.6')
+        finally:
+            utils.invalidate_local_ip_cache()
+
+    def test_find_available_port(self):
+        """测试可用端口查找跳过已占用的端口"""
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as busy:
+            busy.bind(('', 0))
+            port = busy.getsockname()[1]
+            self.assertFalse(is_port_available(port))
+            found = find_available_port(port, max_attempts=20)
+            self.assertIsNotNone(found)
+            self.assertNotEqual(found, port)
+
+        # 单个端口检查出错时跳过该端口继续查找
+        def flaky(candidate):
+            if candidate == 40000:
+                raise OSError(errno.EMFILE, "Too many open files")
+            return True
+
+        with patch('utils.is_port_available', side_effect=flaky), \
+                patch('utils._get_used_ports', return_value=None):
+            self.assertEqual(find_available_port(40000, max_attempts=5), 40001)
+
+    def test_used_ports_only_bound_states(self):
+        """测试内核socket表中只有监听/已绑定状态的端口视为占用"""
+        import utils
+        table = (
+            "  sl  local_address rem_address   st tx_queue rx_queue\n"
+            "   0: 00000000:2EE0 00000000:0000 0A 00000000:00000000\n"  # 12000 LISTEN
+            "   1: 0100007F:2EE1 0100007F:9C40 06 00000000:00000000\n"  # 12001 TIME_WAIT
+            "   2: 00000000:2EE2 00000000:0000 07 00000000:00000000\n"  # 12002 已绑定
+        )
+        with patch('builtins.open', mock_open(read_data=table)):
+            used = utils._get_used_ports()
+        # 同一份数据分别作为TCP表（只计0A）和UDP表（只计07）读取
+        self.assertEqual(used, {12000, 12002})
+
+    def test_get_timestamp(self):
+        """测试整数秒时间戳"""
+        with patch('time.time_ns', return_value=1_700_000_000_999_999_999):
+            self.assertEqual(get_timestamp(), 1_700_000_000)
+
+    def test_format_time(self):
+        """测试同一秒内的浮点时间戳格式化结果一致"""
+        self.assertEqual(format_time(1_700_000_000.75), format_time(1_700_000_000))
+        self.assertRegex(format_time(1_700_000_000), r'^\d{2}:\d{2}:\d{2}$')
+
+    def test_serialize_roundtrip(self):
+        """测试消息序列化与反序列化"""
+        message = {"type": "NODE_DISCOVERY", "name": "节点A", "port": 12000}
+        data = serialize_message(message)
+
+        self.assertIsInstance(data, bytes)
+        self.assertIn("节点A".encode('utf-8'), data)
+        self.assertEqual(deserialize_message(data), message)
+        self.assertEqual(deserialize_message(memoryview(bytearray(data))), message)
+
+    def test_wire_format_independent_of_orjson(self):
+        """测试未安装orjson时发出的报文与orjson的紧凑格式一致"""
+        with patch('time.time', return_value=1_700_000_000):
+            message = Protocol.create_send_offer("192.168.1.100", 12000, "文件.bin", 10, "")
+            with patch('protocol.orjson', None):
+                fallback = Protocol.create_send_offer("192.168.1.100", 12000, "文件.bin", 10, "")
+        self.assertNotIn(b'": ', fallback)
+        self.assertEqual(fallback, message)
+
+    def test_discovery_message_template(self):
+        """测试节点发现消息模板"""
+        prefix, suffix = Protocol.create_discovery_template(
+            "test_node", "192.168.1.100", 12000)
+        parsed = Protocol.parse_message(prefix + b"1700000000" + suffix)
+
+        self.assertIsNotNone(parsed)
+        self.assertEqual(parsed['type'], MessageType.NODE_DISCOVERY)
+        self.assertEqual(parsed['name'], "test_node")
+        self.assertEqual(parsed['port'], 12000)
+        self.assertEqual(parsed['timestamp'], 1700000000)
+
+    def test_discovery_frame(self):
+        """测试二进制节点发现帧"""
+        frame = Protocol.create_discovery_frame("节点A", "192.168.1.100", 12000)
+        self.assertEqual(frame[0], Protocol.DISCOVERY_MAGIC)
+
+        Protocol.DISCOVERY_TIMESTAMP.pack_into(
+            frame, Protocol.DISCOVERY_TIMESTAMP_OFFSET, 1700000000)
+        parsed = Protocol.parse_discovery_frame(memoryview(frame))
+
+        self.assertEqual(parsed['type'], MessageType.NODE_DISCOVERY)
+        self.assertEqual(parsed['name'], "节点A")
+        self.assertEqual(parsed['ip'], "192.168.1.100")
+        self.assertEqual(parsed['port'], 12000)
+        self.assertEqual(parsed['timestamp'], 1700000000)
+
+        # 截断的帧不应被解析
+        self.assertIsNone(Protocol.parse_discovery_frame(frame[:-1]))
+
+    def test_send_datagrams_batch(self):
+        """测试UDP报文批量发送"""
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            receiver.bind(("127.0.0.1", 0))
+            receiver.settimeout(1)
+            addr = receiver.getsockname()
+
+            payloads = [f"msg_{i}".encode() for i in range(5)]
+            sent = send_datagrams(sender, [(p, addr) for p in payloads])
+            self.assertEqual(sent, 5)
+
+            received = [receiver.recvfrom(1024)[0] for _ in payloads]
+            self.assertEqual(received, payloads)
+        finally:
+            receiver.close()
+            sender.close()
+
+    @unittest.skipUnless(BatchReceiver.is_supported(), "需要recvmmsg支持")
+    def test_batch_receiver(self):
+        """测试recvmmsg批量接收"""
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            receiver.bind(("127.0.0.1", 0))
+            addr = receiver.getsockname()
+            batch = BatchReceiver(count=8, size=64)
+
+            self.assertEqual(batch.recv(receiver), 0)
+
+            payloads = [f"msg_{i}".encode() for i in range(3)]
+            for p in payloads:
+                sender.sendto(p, addr)
+            # 本机回环发送时报文同步入队，等到可读即可，不必固定休眠
+            select.select([receiver], [], [], 1)
+
+            count = batch.recv(receiver)
+            self.assertEqual(count, 3)
+            self.assertEqual([bytes(batch.get(i)[0]) for i in range(count)],
+                             payloads)
+        finally:
+            receiver.close()
+            sender.close()
+
+    def test_parse_arguments(self):
+        """测试命令行参数解析"""
+        args = parse_arguments([])
+        self.assertEqual((args.port, args.broadcast_port, args.name),
+                         (12000, 23333, None))
+
+        args = parse_arguments(['-p', '12001', '--broadcast-port=23334',
+                                '--name', '我的节点'])
+        self.assertEqual((args.port, args.broadcast_port, args.name),
+                         (12001, 23334, '我的节点'))
+
+        # 与argparse相同的紧凑写法：短选项直接跟值、长选项前缀
+        args = parse_arguments(['-p12002', '--broad', '23335', '--na=节点'])
+        self.assertEqual((args.port, args.broadcast_port, args.name),
+                         (12002, 23335, '节点'))
+
+        with self.assertRaises(SystemExit), \
+                contextlib.redirect_stderr(io.StringIO()):
+            parse_arguments(['-p', 'abc'])
+
 
 class TestIntegration(unittest.TestCase):
     """集成测试"""
@@ -150,6 +533,7 @@ class TestIntegration(unittest.TestCase):
     def test_neighbor_lifecycle(self):
         """测试邻居生命周期"""
         neighbor_manager = NeighborManager()
+        self.addCleanup(neighbor_manager.stop)
 
         # 添加邻居
         node_info = {
@@ -170,16 +554,129 @@ class TestIntegration(unittest.TestCase):
         node_key = "192.168.1.101:12001"
         neighbor = neighbor_manager.get_neighbor(node_key)
         self.assertIsNotNone(neighbor)
-        self.assertEqual(neighbor['name'], 'remote_node')
+        self.assertEqual(neighbor.name, 'remote_node')
+
+        # 整数键与字符串键指向同一个邻居
+        int_key = make_node_key('192.168.1.101', 12001)
+        self.assertEqual(split_node_key(int_key), ('192.168.1.101', 12001))
+        self.assertIs(neighbor_manager.get_neighbor(int_key), neighbor)
+
+    def test_neighbor_heartbeats_reuse_expiry_entry(self):
+        """测试心跳不向过期堆压入新表项，仍有心跳的节点不会过期"""
+        neighbor_manager = NeighborManager(timeout_seconds=0.5)
+        self.addCleanup(neighbor_manager.stop)
+        node_info = {'ip': '192.168.1.101', 'port': 12001, 'name': 'remote_node'}
+
+        for _ in range(100):
+            neighbor_manager.add_or_update_neighbor(node_info)
+        self.assertEqual(len(neighbor_manager._expiry_heap), 1)
+
+        # 持续心跳超过一个超时周期，节点保持在线
+        for _ in range(8):
+            time.sleep(0.1)
+            neighbor_manager.add_or_update_neighbor(node_info)
+        self.assertEqual(neighbor_manager.get_neighbor_count(), 1)
+        self.assertEqual(len(neighbor_manager._expiry_heap), 1)
+
+        # 停止心跳后过期移除
+        deadline = time.monotonic() + 5
+        while neighbor_manager.get_neighbor_count() and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(neighbor_manager.get_neighbor_count(), 0)
+
+    def test_loopback_file_transfer(self):
+        """测试经本机TCP连接的完整文件传输：空文件及超过一个sendfile窗口的文件"""
+        with offline_components():
+            sender = FileSender("127.0.0.1", 12000)
+            receiver = FileReceiver("127.0.0.1", 12000)
+
+        for size in (0, _SENDFILE_WINDOW + 12345):
+            for hash_alg in (Protocol.HASH_MD5, Protocol.HASH_MD5X8):
+                with self.subTest(size=size, hash_alg=hash_alg), \
+                        tempfile.TemporaryDirectory() as work_dir:
+                    source = os.path.join(work_dir, "source.bin")
+                    with open(source, 'wb') as f:
+                        f.write(os.urandom(size))
+                    receiver.set_download_directory(os.path.join(work_dir, "dl"))
+
+                    listen_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                    listen_sock.bind(("127.0.0.1", 0))
+                    listen_sock.listen(1)
+                    port = listen_sock.getsockname()[1]
+
+                    results = {}
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        receive_thread = threading.Thread(
+                            target=receiver._receive_file_data,
+                            args=(listen_sock, "received.bin", size, "",
+                                  lambda ok, msg: results.setdefault('recv', ok)))
+                        receive_thread.start()
+                        sender._start_file_transfer(
+                            TransferCtx.from_path(source), "127.0.0.1", port,
+                            lambda ok, msg: results.setdefault('send', ok), hash_alg)
+                        receive_thread.join(30)
+
+                    self.assertEqual(results, {'send': True, 'recv': True})
+                    received = os.path.join(work_dir, "dl", "received.bin")
+                    with open(source, 'rb') as a, open(received, 'rb') as b:
+                        self.assertEqual(a.read(), b.read())
+                    self.assertEqual(Protocol.calculate_file_hash(received, hash_alg),
+                                     Protocol.calculate_file_hash(source, hash_alg))
+
+    def test_neighbor_lookup_by_name(self):
+        """测试按名称查找邻居"""
+        neighbor_manager = NeighborManager()
+        self.addCleanup(neighbor_manager.stop)
+        neighbor_manager.add_or_update_neighbor(
+            {'ip': '192.168.1.101', 'port': 12001, 'name': 'node_a'})
+
+        node_key, node_info = neighbor_manager.get_neighbor_by_name('node_a')
+        self.assertEqual(node_key, make_node_key('192.168.1.101', 12001))
+        self.assertEqual(node_info.port, 12001)
+
+        # 改名后旧名称不再可用
+        neighbor_manager.add_or_update_neighbor(
+            {'ip': '192.168.1.101', 'port': 12001, 'name': 'node_b'})
+        self.assertEqual(neighbor_manager.get_neighbor_by_name('node_a'),
+                         (None, None))
+        self.assertEqual(neighbor_manager.get_all_names(), ['node_b'])
+
+        neighbor_manager.remove_neighbor(node_key)
+        self.assertEqual(neighbor_manager.get_all_names(), [])
+        self.assertEqual(neighbor_manager.get_neighbor_by_name('node_b'),
+                         (None, None))
+
+    def test_unique_node_name(self):
+        """测试自动节点名称取最小的未使用编号"""
+        neighbor_manager = NeighborManager()
+        self.addCleanup(neighbor_manager.stop)
+        self.assertEqual(generate_unique_node_name(neighbor_manager), "node_1")
+
+        for i, name in enumerate(["node_1", "node_2", "node_4", "other"]):
+            neighbor_manager.add_or_update_neighbor(
+                {'ip': f'192.168.1.{101 + i}', 'port': 12000, 'name': name})
+        self.assertEqual(generate_unique_node_name(neighbor_manager), "node_3")
+
+        neighbor_manager.remove_neighbor("192.168.1.101:12000")
+        self.assertEqual(generate_unique_node_name(neighbor_manager), "node_1")
+
+        # 改名释放旧编号
+        neighbor_manager.add_or_update_neighbor(
+            {'ip': '192.168.1.101', 'port': 12000, 'name': 'node_1'})
+        neighbor_manager.add_or_update_neighbor(
+            {'ip': '192.168.1.102', 'port': 12000, 'name': 'node_3'})
+        self.assertEqual(generate_unique_node_name(neighbor_manager), "node_2")
 
     def test_system_components_integration(self):
         """测试系统组件集成"""
         # 创建邻居管理器
         neighbor_manager = NeighborManager()
+        self.addCleanup(neighbor_manager.stop)
 
         # 创建文件组件
-        file_sender = FileSender("192.168.1.100", 12000)
-        file_receiver = FileReceiver("192.168.1.100", 12000)
+        with offline_components():
+            file_sender = FileSender("192.168.1.100", 12000)
+            file_receiver = FileReceiver("192.168.1.100", 12000)
 
         # 创建监听器
         listener = BroadcastListener(
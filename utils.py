@@ -1,56 +1,231 @@
 import socket
+import errno
 import time
-import json
 import platform
+import ctypes
+import ctypes.util
+import struct
+import queue
+import sys
+import threading
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from protocol import Protocol, json_dumps
+
+# 可选依赖：netifaces通过getifaddrs直接枚举网卡地址，不经过DNS解析
+try:
+    import netifaces
+except ImportError:
+    netifaces = None
+
+
+# sendmmsg批量发送相关的C结构体定义（仅Linux可用）
+class _Iovec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p),
+                ("iov_len", ctypes.c_size_t)]
+
+
+class _SockaddrIn(ctypes.Structure):
+    _fields_ = [("sin_family", ctypes.c_ushort),
+                ("sin_port", ctypes.c_uint8 * 2),   # 网络字节序
+                ("sin_addr", ctypes.c_uint8 * 4),
+                ("sin_zero", ctypes.c_uint8 * 8)]
+
+
+class _Msghdr(ctypes.Structure):
+    _fields_ = [("msg_name", ctypes.c_void_p),
+                ("msg_namelen", ctypes.c_uint32),
+                ("msg_iov", ctypes.POINTER(_Iovec)),
+                ("msg_iovlen", ctypes.c_size_t),
+                ("msg_control", ctypes.c_void_p),
+                ("msg_controllen", ctypes.c_size_t),
+                ("msg_flags", ctypes.c_int)]
+
+
+class _Mmsghdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", _Msghdr),
+                ("msg_len", ctypes.c_uint)]
+
+
+def _load_libc_func(name, argtypes):
+    """加载libc中的批量收发函数，不支持的平台返回None"""
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        func = getattr(libc, name)
+    except (OSError, AttributeError, TypeError):
+        return None
+    func.argtypes = argtypes
+    func.restype = ctypes.c_int
+    return func
+
+
+_libc_sendmmsg = _load_libc_func(
+    'sendmmsg', [ctypes.c_int, ctypes.POINTER(_Mmsghdr),
+                 ctypes.c_uint, ctypes.c_int])
+_libc_recvmmsg = _load_libc_func(
+    'recvmmsg', [ctypes.c_int, ctypes.POINTER(_Mmsghdr),
+                 ctypes.c_uint, ctypes.c_int, ctypes.c_void_p])
+
+# 单次sendmmsg调用的最大报文数
+MAX_SEND_BATCH = 100
+
+# sockaddr_in中sin_family之后的端口（网络字节序）和IPv4地址，一次解包取出
+_SOCKADDR_PORT_ADDR = struct.Struct('!H4s')
+_SOCKADDR_PORT_OFFSET = _SockaddrIn.sin_port.offset
+
+
+# get_local_ip探测成功的结果；探测失败返回的默认值不缓存，下次调用会重新探测
+_cached_local_ip = None
+_local_ip_lock = threading.Lock()
 
 
 def get_local_ip():
-    """获取本机局域网IP地址"""
+    """获取本机局域网IP地址
+
+    结果会被缓存，网络环境变化后可调用 invalidate_local_ip_cache() 重新探测
+    """
+    global _cached_local_ip
+    local_ip = _cached_local_ip
+    if local_ip is not None:
+        return local_ip
+
+    with _local_ip_lock:
+        if _cached_local_ip is None:
+            _cached_local_ip = _probe_local_ip()
+        return _cached_local_ip or "192.168.1.100"  # 默认值
+
+
+def invalidate_local_ip_cache():
+    """清除缓存的本机IP地址，下次调用get_local_ip时重新探测"""
+    global _cached_local_ip
+    with _local_ip_lock:
+        _cached_local_ip = None
+
+
+def _probe_local_ip():
+    """探测本机局域网IP地址，失败时返回None"""
     try:
         # 创建一个UDP socket
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        # 连接到远程地址（不会实际发送数据）
-        s.connect(("8.8.8.8", 80))
-        local_ip = s.getsockname()[0]
-        s.close()
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            # 连接到远程地址（不会实际发送数据）
+            s.connect(("8.8.8.8", 80))
+            return s.getsockname()[0]
+    except Exception:
+        pass
+
+    # 如果上述方法失败，优先枚举网卡地址，未安装netifaces时才解析主机名
+    if netifaces is not None:
+        return _interface_ip()
+    try:
+        hostname = socket.gethostname()
+        local_ip = socket.gethostbyname(hostname)
+        if local_ip.startswith("127."):
+            # 如果返回回环地址，尝试其他方法
+            return None
         return local_ip
     except Exception:
-        # 如果上述方法失败，使用备用方法
-        try:
-            hostname = socket.gethostname()
-            local_ip = socket.gethostbyname(hostname)
-            if local_ip.startswith("127."):
-                # 如果返回回环地址，尝试其他方法
-                return "192.168.1.100"  # 默认值
-            return local_ip
-        except Exception:
-            return "192.168.1.100"  # 默认值
+        return None
+
+
+def _interface_ip():
+    """返回第一个非回环、非链路本地的网卡IPv4地址，没有时返回None"""
+    try:
+        for iface in netifaces.interfaces():
+            for addr in netifaces.ifaddresses(iface).get(netifaces.AF_INET, ()):
+                ip = addr.get('addr', '')
+                if ip and not ip.startswith(('127.', '169.254.')):
+                    return ip
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+# 表示端口已被占用或无权使用的绑定错误，其余错误不代表端口不可用
+# Windows上无权使用端口时报告的是WSAEACCES
+PORT_UNUSABLE_ERRNOS = frozenset((errno.EADDRINUSE, errno.EACCES,
+                                  errno.EADDRNOTAVAIL,
+                                  getattr(errno, 'WSAEACCES', errno.EACCES)))
+
+# Windows上SO_REUSEADDR允许绑定其他socket正在监听的端口，检测时改用
+# SO_EXCLUSIVEADDRUSE；其他平台用SO_REUSEADDR忽略TIME_WAIT状态的端口
+if sys.platform == 'win32':
+    _PORT_PROBE_SOCKOPT = getattr(socket, 'SO_EXCLUSIVEADDRUSE', None)
+else:
+    _PORT_PROBE_SOCKOPT = socket.SO_REUSEADDR
 
 
 def is_port_available(port):
     """检查端口是否可用
 
-    同时检查TCP和UDP端口是否可用
+    同时检查TCP和UDP端口是否可用；两个socket由上下文管理器关闭，
+    绑定失败时也会立即释放文件描述符
+
+    Raises:
+        OSError: 与端口本身无关的错误，如文件描述符耗尽
     """
     try:
-        # 检查TCP端口
-        tcp_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        tcp_sock.bind(('', port))
-        tcp_sock.close()
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as tcp_sock, \
+                socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as udp_sock:
+            if _PORT_PROBE_SOCKOPT is not None:
+                tcp_sock.setsockopt(socket.SOL_SOCKET, _PORT_PROBE_SOCKOPT, 1)
+            tcp_sock.bind(('', port))
+            udp_sock.bind(('', port))
+        return True
+    except OverflowError:
+        return False  # 端口号超出0-65535
+    except OSError as e:
+        if e.errno in PORT_UNUSABLE_ERRNOS:
+            return False
+        raise
+
+
+# 记录本机socket的内核表及视为占用端口的状态（第四列st）：TCP只计LISTEN(0A)，
+# UDP只计未连接的已绑定socket(07)。TIME_WAIT等状态的端口在SO_REUSEADDR下
+# 可以绑定，不预先排除；预筛选遗漏的端口仍会由绑定检查发现
+_PROC_NET_TABLES = (('/proc/net/tcp', '0A'), ('/proc/net/tcp6', '0A'),
+                    ('/proc/net/udp', '07'), ('/proc/net/udp6', '07'))
+
+
+def _get_used_ports():
+    """读取Linux内核的socket表，返回已占用的本地端口集合；不支持时返回None"""
+    used = set()
+    found = False
+    for path, bound_state in _PROC_NET_TABLES:
+        try:
+            with open(path) as f:
+                next(f, None)  # 表头
+                for line in f:
+                    # sl local_address rem_address st ...
+                    fields = line.split(None, 4)
+                    if len(fields) > 3 and fields[3] == bound_state:
+                        used.add(int(fields[1].rsplit(':', 1)[1], 16))
+        except (OSError, ValueError, IndexError):
+            continue
+        found = True
+    return frozenset(used) if found else None
 
-        # 检查UDP端口
-        udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        udp_sock.bind(('', port))
-        udp_sock.close()
 
-        return True
-    except:
+# find_available_port并发探测端口的线程数
+_PORT_PROBE_WORKERS = 16
+
+
+def _probe_port(port):
+    """检查单个候选端口，出现与端口无关的错误（如文件描述符耗尽）时视为不可用"""
+    try:
+        return is_port_available(port)
+    except OSError:
         return False
 
 
 def find_available_port(start_port, max_attempts=100):
     """查找可用端口
 
+    Linux上先读取一次内核socket表排除已占用的端口，其余候选端口以
+    _PORT_PROBE_WORKERS个为一组并发做绑定检查，返回编号最小的可用端口；
+    检查某个端口时出错只跳过该端口，不中断查找
+
     Args:
         start_port: 起始端口号
         max_attempts: 最大尝试次数
@@ -58,21 +233,278 @@ def find_available_port(start_port, max_attempts=100):
     Returns:
         找到的可用端口号，如果没找到返回None
     """
-    for port in range(start_port, start_port + max_attempts):
-        if is_port_available(port):
-            return port
+    used_ports = _get_used_ports() or frozenset()
+    candidates = [port for port in range(start_port, start_port + max_attempts)
+                  if port not in used_ports]
+
+    # 按窗口并发探测，每个窗口内取编号最小的可用端口；
+    # 绑定是系统调用，执行期间释放GIL
+    with ThreadPoolExecutor(max_workers=_PORT_PROBE_WORKERS) as pool:
+        for i in range(0, len(candidates), _PORT_PROBE_WORKERS):
+            window = candidates[i:i + _PORT_PROBE_WORKERS]
+            for port, available in zip(window, pool.map(_probe_port, window)):
+                if available:
+                    return port
     return None
 
 
+def set_socket_buffers(sock, size, send=True):
+    """设置socket接收（及发送）缓冲区大小
+
+    内核会把请求值限制在net.core.rmem_max/wmem_max以内，设置后通过
+    getsockopt读回实际大小，不足请求值时打印警告
+
+    Returns:
+        实际生效的接收缓冲区大小
+    """
+    options = [(socket.SO_RCVBUF, "rmem_max")]
+    if send:
+        options.append((socket.SO_SNDBUF, "wmem_max"))
+
+    actual_rcvbuf = 0
+    for option, sysctl in options:
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, option, size)
+            actual = sock.getsockopt(socket.SOL_SOCKET, option)
+        except OSError as e:
+            print(f"[警告] 设置socket缓冲区失败: {e}")
+            continue
+        if option == socket.SO_RCVBUF:
+            actual_rcvbuf = actual
+        if actual < size:
+            print(f"[警告] socket缓冲区被内核限制为 {format_file_size(actual)}，"
+                  f"低于请求的 {format_file_size(size)}，"
+                  f"可调大 net.core.{sysctl}")
+    return actual_rcvbuf
+
+
+def send_datagrams(sock, datagrams):
+    """批量发送UDP报文
+
+    Args:
+        sock: 已创建的UDP socket
+        datagrams: [(data, (ip, port)), ...] 报文列表
+
+    在Linux上使用一次sendmmsg系统调用发送全部报文，
+    其他平台或地址无法转换时退化为逐个sendto；只有一个报文时
+    sendto本身就是一次系统调用，直接发送以省去构造C结构体的开销
+
+    Returns:
+        成功发送的报文数量
+    """
+    if not datagrams:
+        return 0
+
+    sent = 0
+    if (len(datagrams) > 1 and _libc_sendmmsg is not None
+            and sock.family == socket.AF_INET):
+        sent = _sendmmsg(sock, datagrams)
+
+    # 剩余未发送的报文逐个发送
+    for data, addr in datagrams[sent:]:
+        sock.sendto(data, addr)
+        sent += 1
+    return sent
+
+
+def _sendmmsg(sock, datagrams):
+    """通过sendmmsg发送报文，返回成功发送的数量，失败时返回0"""
+    count = len(datagrams)
+    msgs = (_Mmsghdr * count)()
+    iovs = (_Iovec * count)()
+    addrs = (_SockaddrIn * count)()
+    buffers = []  # 保持缓冲区引用直到系统调用结束
+
+    try:
+        for i, (data, (ip, port)) in enumerate(datagrams):
+            if not isinstance(data, bytes):
+                data = bytes(data)
+            buf = ctypes.create_string_buffer(data, len(data))
+            buffers.append(buf)
+            iovs[i].iov_base = ctypes.cast(buf, ctypes.c_void_p)
+            iovs[i].iov_len = len(data)
+
+            addrs[i].sin_family = socket.AF_INET
+            addrs[i].sin_port[:] = list(port.to_bytes(2, 'big'))
+            addrs[i].sin_addr[:] = list(socket.inet_aton(ip))
+
+            hdr = msgs[i].msg_hdr
+            hdr.msg_name = ctypes.cast(ctypes.pointer(addrs[i]),
+                                       ctypes.c_void_p)
+            hdr.msg_namelen = ctypes.sizeof(_SockaddrIn)
+            hdr.msg_iov = ctypes.pointer(iovs[i])
+            hdr.msg_iovlen = 1
+    except (OSError, TypeError, ValueError, OverflowError):
+        # 地址不是IPv4数字格式等情况，交给sendto处理
+        return 0
+
+    result = _libc_sendmmsg(sock.fileno(), msgs, count, 0)
+    return max(result, 0)
+
+
+class BatchReceiver:
+    """基于recvmmsg的UDP批量接收器
+
+    预先分配count个缓冲区及地址结构，一次系统调用取出socket中
+    积压的多个报文。非Linux平台上recv()始终返回0，由调用方退回
+    普通的recvfrom流程。
+    """
+
+    def __init__(self, count=32, size=2048):
+        self.count = count
+        self.size = size
+        self._bufs = [bytearray(size) for _ in range(count)]
+        self._views = [memoryview(buf) for buf in self._bufs]
+        self._msgs = (_Mmsghdr * count)()
+        self._iovs = (_Iovec * count)()
+        self._addrs = (_SockaddrIn * count)()
+        self._c_bufs = []
+
+        for i, buf in enumerate(self._bufs):
+            c_buf = (ctypes.c_char * size).from_buffer(buf)
+            self._c_bufs.append(c_buf)
+            self._iovs[i].iov_base = ctypes.addressof(c_buf)
+            self._iovs[i].iov_len = size
+
+            hdr = self._msgs[i].msg_hdr
+            hdr.msg_name = ctypes.addressof(self._addrs[i])
+            hdr.msg_iov = ctypes.pointer(self._iovs[i])
+            hdr.msg_iovlen = 1
+
+    @staticmethod
+    def is_supported():
+        """当前平台是否支持recvmmsg"""
+        return _libc_recvmmsg is not None
+
+    def recv(self, sock):
+        """非阻塞地取出socket中已到达的报文，返回取到的数量"""
+        if _libc_recvmmsg is None or sock.family != socket.AF_INET:
+            return 0
+
+        for i in range(self.count):
+            hdr = self._msgs[i].msg_hdr
+            hdr.msg_namelen = ctypes.sizeof(_SockaddrIn)
+            hdr.msg_flags = 0
+
+        result = _libc_recvmmsg(sock.fileno(), self._msgs, self.count,
+                                socket.MSG_DONTWAIT, None)
+        return max(result, 0)
+
+    def get(self, index):
+        """获取第index个报文，返回(memoryview, (ip, port))
+
+        被截断的报文返回(None, addr)
+        """
+        msg = self._msgs[index]
+        port, ip = _SOCKADDR_PORT_ADDR.unpack_from(
+            self._addrs[index], _SOCKADDR_PORT_OFFSET)
+        addr = (socket.inet_ntoa(ip), port)
+        if msg.msg_hdr.msg_flags & socket.MSG_TRUNC:
+            return None, addr
+        return self._views[index][:msg.msg_len], addr
+
+
+class BufferPool:
+    """线程安全的接收缓冲区池
+
+    预先分配count个固定大小的bytearray，acquire()取出、release()归还；
+    池为空时临时分配新的缓冲区，不会阻塞调用方
+    """
+
+    def __init__(self, buffer_size, count=2):
+        self.buffer_size = buffer_size
+        self._free = queue.SimpleQueue()
+        for _ in range(count):
+            self._free.put(bytearray(buffer_size))
+
+    def acquire(self):
+        """取出一个缓冲区"""
+        try:
+            return self._free.get_nowait()
+        except queue.Empty:
+            return bytearray(self.buffer_size)
+
+    def release(self, buf):
+        """归还缓冲区"""
+        self._free.put(buf)
+
+
+def make_node_key(ip, port):
+    """生成节点的整数键
+
+    IPv4地址转为32位整数后左移16位，再与端口号合并，
+    比 "ip:port" 字符串键省去格式化和字符串哈希的开销
+
+    Raises:
+        OSError/TypeError/ValueError: ip不是合法的IPv4地址或端口无效
+    """
+    return (int.from_bytes(socket.inet_aton(ip), 'big') << 16) | int(port)
+
+
+def split_node_key(node_key):
+    """将整数节点键还原为 (ip, port)"""
+    ip = socket.inet_ntoa((node_key >> 16).to_bytes(4, 'big'))
+    return ip, node_key & 0xFFFF
+
+
 def get_timestamp():
-    """获取当前时间戳"""
-    return int(time.time())
+    """获取当前时间戳（整数秒）
+
+    直接对整数纳秒做整除，不经过浮点数
+    """
+    return time.time_ns() // 1_000_000_000
+
+
+def get_monotonic_ns():
+    """获取单调时钟的纳秒值，用于计算时间间隔，不受系统时间调整影响"""
+    return time.monotonic_ns()
+
+
+# 进程内共享的广播发送socket，由get_broadcast_socket()首次调用时创建
+_bcast_sock = None
+_bcast_sock_lock = threading.Lock()
+
+
+def get_broadcast_socket():
+    """返回进程内共享的UDP广播发送socket
+
+    socket只创建一次并一直保留到进程退出，广播发送器停止后再启动时
+    直接复用；已开启SO_BROADCAST、组播TTL为1并设为非阻塞，发送缓冲区满时sendto抛出
+    BlockingIOError而不是阻塞。创建失败时抛出OSError
+    """
+    global _bcast_sock
+    with _bcast_sock_lock:
+        if _bcast_sock is None:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+                # 组播报文只在本网段内传播
+                sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+                try:
+                    sock.setsockopt(
+                        socket.SOL_SOCKET, socket.SO_SNDBUF, 4 * 1024 * 1024)
+                except OSError:
+                    pass  # 内核可能限制缓冲区大小，使用默认值即可
+                sock.setblocking(False)
+            except OSError:
+                sock.close()
+                raise
+            _bcast_sock = sock
+        return _bcast_sock
+
+
+# 节点发现使用的链路本地组播组，TTL为1不出本网段；
+# 许多无线AP会过滤全局广播，但会转发加入了组的链路本地组播
+DISCOVERY_MULTICAST_GROUP = "224.0.0.200"
 
 
 def get_broadcast_address():
-    """获取广播地址"""
-    # 使用全局广播地址，让同一网络内的所有程序都能相互发现
-    return "255.255.255.255"
+    """获取节点发现报文的目标地址列表
+
+    全局广播地址在前，保证原有的发现方式不受组播路由的影响；
+    两种报文内容相同，接收方在去重窗口内只处理一次
+    """
+    return ["255.255.255.255", DISCOVERY_MULTICAST_GROUP]
 
 
 def create_node_info(ip, port, name=None, neighbor_manager=None):
@@ -92,67 +524,50 @@ def create_node_info(ip, port, name=None, neighbor_manager=None):
 def generate_unique_node_name(neighbor_manager=None):
     """生成唯一的节点名称
 
-    根据已存在的节点数量生成新的节点名称
+    取已发现节点中 "node_N" 格式名称未使用的最小编号，编号由
+    NeighborManager在节点增删时维护，无需遍历全部节点
     """
     if neighbor_manager is None:
         return "node_1"
-
-    # 获取所有已存在的节点名称
-    existing_nodes = neighbor_manager.get_all_neighbors()
-    existing_names = set()
-
-    # 收集所有node_N格式的名称
-    for node_key, node_info in existing_nodes.items():
-        name = node_info.get('name', '')
-        if name.startswith('node_'):
-            try:
-                num = int(name.split('_')[1])
-                existing_names.add(num)
-            except (IndexError, ValueError):
-                continue
-
-    # 如果没有任何节点，返回node_1
-    if not existing_names:
-        return "node_1"
-
-    # 找到最小的未使用编号
-    current_num = 1
-    while current_num in existing_names:
-        current_num += 1
-
-    return f"node_{current_num}"
+    return f"node_{neighbor_manager.next_free_node_number()}"
 
 
 def serialize_message(data):
-    """序列化消息为JSON字符串"""
+    """序列化消息为JSON字节串，与协议报文使用同一实现（protocol.json_dumps）"""
     try:
-        return json.dumps(data).encode('utf-8')
-    except Exception as e:
+        return json_dumps(data)
+    except (TypeError, ValueError) as e:  # 包括orjson.JSONEncodeError
         print(f"序列化错误: {e}")
         return b""
 
 
 def deserialize_message(data):
-    """反序列化JSON消息"""
-    try:
-        return json.loads(data.decode('utf-8'))
-    except Exception as e:
-        print(f"反序列化错误: {e}")
-        return None
+    """反序列化JSON消息，支持bytes/bytearray/memoryview，等同于Protocol.parse_message"""
+    return Protocol.parse_message(data)
+
+
+@lru_cache(maxsize=4)
+def _format_second(seconds: int) -> str:
+    """按整数秒格式化，同一秒内的重复调用直接命中缓存"""
+    return time.strftime("%H:%M:%S", time.localtime(seconds))
 
 
 def format_time(timestamp):
     """格式化时间戳为可读字符串"""
-    return time.strftime("%H:%M:%S", time.localtime(timestamp))
+    return _format_second(int(timestamp))
+
+
+# 文件大小单位及对应的字节数，下标为 (位长度-1)//10
+_SIZE_UNITS = (("KB", 1 << 10), ("MB", 1 << 20), ("GB", 1 << 30))
 
 
 def format_file_size(size_bytes):
-    """格式化文件大小"""
+    """格式化文件大小
+
+    由整数位长度直接算出单位下标，不再逐级比较
+    """
     if size_bytes < 1024:
         return f"{size_bytes} B"
-    elif size_bytes < 1024 * 1024:
-        return f"{size_bytes / 1024:.1f} KB"
-    elif size_bytes < 1024 * 1024 * 1024:
-        return f"{size_bytes / (1024 * 1024):.1f} MB"
-    else:
-        return f"{size_bytes / (1024 * 1024 * 1024):.1f} GB"
+    index = min((int(size_bytes).bit_length() - 1) // 10, len(_SIZE_UNITS))
+    unit, scale = _SIZE_UNITS[index - 1]
+    return f"{size_bytes / scale:.1f} {unit}"